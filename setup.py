@@ -130,11 +130,14 @@ setup(
             "array_rotate = xicam.SAXS.operations.arrayrotate:array_rotate",
             "one_time_correlation = xicam.SAXS.operations.onetime:one_time_correlation",
             "two_time_correlation = xicam.SAXS.operations.twotime:two_time_correlation",
+            "matmul_two_time_correlation = xicam.SAXS.operations.twotime:matmul_two_time_correlation",
+            "age_lag_two_time_correlation = xicam.SAXS.operations.twotime:age_lag_two_time_correlation",
             "fit_scattering_factor = xicam.SAXS.operations.fitting:fit_scattering_factor",
             "correct_fastccd_image = xicam.SAXS.operations.correction:correct_fastccd_image",
             "chi_squared = xicam.SAXS.operations.chisquared:chi_squared",
             "astropyfit = xicam.SAXS.operations.astropyfit:AstropyQSpectraFit",
             "q_integrate = xicam.SAXS.operations.qintegrate:q_integrate",
+            "preprocess_frames = xicam.SAXS.operations.preprocess:preprocess_frames",
             "fourier_correlation = xicam.SAXS.operations.fourierautocorrelator:fourier_correlation",
             "inpaint = xicam.SAXS.operations.inpaint:inpaint",
             "q_conversion_gisaxs = xicam.SAXS.operations.qconversiongisaxs:q_conversion_gisaxs",
@@ -156,10 +159,12 @@ setup(
             'xicam.SAXS.calibration = xicam.SAXS.calibration:DeviceProfiles'
         ],
         'xicam.plugins.IntentCanvasPlugin': [
-            'saxs_image_intent_canvas = xicam.SAXS.canvases:SAXSImageIntentCanvas'
+            'saxs_image_intent_canvas = xicam.SAXS.canvases:SAXSImageIntentCanvas',
+            'saxs_error_bar_intent_canvas = xicam.SAXS.canvases:ErrorBarIntentCanvas'
         ],
         "databroker.intents": [
             "SAXSImageIntent = xicam.SAXS.intents:SAXSImageIntent",
+            "SAXSErrorBarIntent = xicam.SAXS.intents:SAXSErrorBarIntent",
         ],
     },
 
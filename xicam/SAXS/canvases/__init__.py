@@ -1,10 +1,15 @@
+import numpy as np
+import pyqtgraph as pg
+from qtpy.QtCore import QTimer
 from xicam.SAXS.widgets.SAXSToolbar import SAXSToolbarBase, ROIs
 from xicam.plugins import manager as plugin_manager
 from xicam.plugins import live_plugin
-from xicam.gui.canvases import ImageIntentCanvas
+from xicam.core.intents import PlotIntent
+from xicam.gui.canvases import ImageIntentCanvas, PlotIntentCanvas
 from xicam.gui.widgets.imageviewmixins import LogScaleIntensity, ImageViewHistogramOverflowFix, \
     QCoordinates, Crosshair, BetterButtons, CenterMarker, ToolbarLayout, EwaldCorrected, ROICreator
 
+from xicam.SAXS.utils import computed_frames
 from xicam.SAXS.widgets.imageviewmixins import BackgroundCorrected
 
 
@@ -35,3 +40,77 @@ class SAXSImageIntentCanvas(ImageIntentCanvas):
             self.canvas_widget.set_darks(intent._darks)
         if hasattr(intent, "log_scale"):
             self.canvas_widget.setLogScale(intent.log_scale)
+
+
+class ErrorBarIntentCanvas(PlotIntentCanvas):
+    """Plot canvas for SAXSErrorBarIntent: one curve and error bar item per row of y, each with its own row of x.
+
+    xicam's PlotIntentCanvas plots every curve against a single x and draws a single error bar item (pyqtgraph's
+    ErrorBarItem only draws one curve). Lazily integrated rows are drawn once they are computed in the background;
+    until then the canvas redraws them every `refresh_interval` ms.
+    """
+    # ErrorBarItem options that hold one value per point; the other options apply to every error bar
+    per_point_kwargs = ('height', 'width', 'top', 'bottom', 'left', 'right')
+    error_bar_kwargs = per_point_kwargs + ('beam', 'pen')
+    refresh_interval = 1000
+
+    def __init__(self, *args, **kwargs):
+        super(ErrorBarIntentCanvas, self).__init__(*args, **kwargs)
+        self._pending_intents = []
+        self._refresh_timer = QTimer(self)
+        self._refresh_timer.timeout.connect(self._refresh_pending)
+
+    def _computed_rows(self, intent):
+        # Rows that are not computed yet read as NaN rather than being computed on the GUI thread
+        keys = [key for key in intent.kwargs if key in self.per_point_kwargs]
+        (x, y, *values), complete = computed_frames(intent.x, intent.y, *(intent.kwargs[key] for key in keys))
+        ys = np.atleast_2d(y.squeeze())
+        xs = np.broadcast_to(np.arange(ys.shape[-1]) if x is None else x.squeeze(), ys.shape)
+        per_point = {key: np.broadcast_to(value.squeeze(), ys.shape) for key, value in zip(keys, values)}
+        return xs, ys, per_point, complete
+
+    def render(self, intent):
+        xs, ys, per_point, complete = self._computed_rows(intent)
+
+        # Plot the curves by index as a plain plot intent, then move them onto their rows of x
+        kwargs = {key: value for key, value in intent.kwargs.items() if key not in self.error_bar_kwargs}
+        curves_intent = PlotIntent(intent.name, None, np.zeros(ys.shape), intent.labels, mixins=intent.mixins,
+                                   canvas_name=intent._canvas_name, match_key=intent.match_key, **kwargs)
+        items = super(ErrorBarIntentCanvas, self).render(curves_intent)
+        self.intent_to_items[intent] = self.intent_to_items.pop(curves_intent)
+
+        error_kwargs = {key: value for key, value in intent.kwargs.items()
+                        if key in self.error_bar_kwargs and key not in self.per_point_kwargs}
+        for _ in range(len(ys)):
+            error_item = pg.ErrorBarItem(**error_kwargs)
+            self.canvas_widget.plotItem.addItem(error_item)
+            items.append(error_item)
+        self._set_rows(items, xs, ys, per_point)
+
+        if not complete:
+            self._pending_intents.append(intent)
+            self._refresh_timer.start(self.refresh_interval)
+        return items
+
+    def unrender(self, intent) -> bool:
+        if intent in self._pending_intents:
+            self._pending_intents.remove(intent)
+        return super(ErrorBarIntentCanvas, self).unrender(intent)
+
+    @staticmethod
+    def _set_rows(items, xs, ys, per_point):
+        curves, error_items = items[:len(ys)], items[len(ys):]
+        for i, (curve, error_item, row_x, y) in enumerate(zip(curves, error_items, xs, ys)):
+            computed = ~np.isnan(y).all()
+            curve.setData(x=row_x if computed else [], y=y if computed else [])
+            error_item.setData(x=row_x if computed else np.empty(0), y=y if computed else np.empty(0),
+                               **{key: value[i] if computed else np.empty(0) for key, value in per_point.items()})
+
+    def _refresh_pending(self):
+        for intent in list(self._pending_intents):
+            xs, ys, per_point, complete = self._computed_rows(intent)
+            self._set_rows(self.intent_to_items[intent], xs, ys, per_point)
+            if complete:
+                self._pending_intents.remove(intent)
+        if not self._pending_intents:
+            self._refresh_timer.stop()
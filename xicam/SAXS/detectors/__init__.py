@@ -3,7 +3,28 @@ import numpy as np
 from collections import OrderedDict
 
 
-class FastCCD(detectors.Detector):
+class CompactPickleMixin(object):
+    """Compact pickling for plain pixel-grid detectors.
+
+    The cached pixel corners are dropped (they are recomputed on demand) and binary masks are sent bit-packed.
+    """
+    def __getstate__(self):
+        state = super(CompactPickleMixin, self).__getstate__()
+        state['_pixel_corners'] = None
+        mask = state.get('_mask')
+        if isinstance(mask, np.ndarray) and mask.size and 0 <= mask.min() and mask.max() <= 1:
+            state['_mask'] = (np.packbits(mask.astype(bool)), mask.shape, mask.dtype.str)
+        return state
+
+    def __setstate__(self, state):
+        mask = state.get('_mask')
+        if isinstance(mask, tuple):
+            packed, shape, dtype = mask
+            state['_mask'] = np.unpackbits(packed, count=int(np.prod(shape))).reshape(shape).astype(dtype)
+        super(CompactPickleMixin, self).__setstate__(state)
+
+
+class FastCCD(CompactPickleMixin, detectors.Detector):
     aliases = ['Fast CCD']
     MAX_SHAPE = (960, 2050)
 
@@ -24,7 +45,7 @@ class FastCCD(detectors.Detector):
         return mask
 
 
-class LAMBDA(detectors.Detector):
+class LAMBDA(CompactPickleMixin, detectors.Detector):
     aliases = ['LAMBDA']
     MAX_SHAPE = (1536, 512)
 
@@ -1,14 +1,17 @@
-from xicam.core.intents import ImageIntent
+from xicam.core.intents import ErrorBarIntent, ImageIntent
 
 
 class SAXSImageIntent(ImageIntent):
 
     canvas = "saxs_image_intent_canvas"
 
-    def __init__(self, name: str, image, *args, device_name: str = None, geometry=None, log_scale=True, **kwargs):
+    def __init__(self, name: str, image, *args, device_name: str = None, geometry=None, geometries=None, log_scale=True,
+                 **kwargs):
         super(SAXSImageIntent, self).__init__(name, image, *args, **kwargs)
 
         self.geometry = geometry
+        # One geometry per frame, for scans that move the detector or sample (None when it is static)
+        self.geometries = geometries
         self.log_scale = log_scale
         self.device_name = device_name
 
@@ -19,3 +22,9 @@ class GISAXSImageIntent(SAXSImageIntent):
         super(GISAXSImageIntent, self).__init__(name, image, *args, **kwargs)
 
         self.incidence_angle = incidence_angle
+
+
+class SAXSErrorBarIntent(ErrorBarIntent):
+    """xicam's ErrorBarIntent, drawn with one curve and error bar item per row of `y` (and of `x`, when 2D)."""
+
+    canvas = "saxs_error_bar_intent_canvas"
@@ -1,5 +1,5 @@
 import numpy as np
-from xicam.SAXS.utils import get_label_array
+from xicam.SAXS.utils import get_label_array, iter_frame_chunks, label_pixel_index
 
 from xicam.plugins.operationplugin import intent, operation, output_names, visible
 from xicam.core.intents import PlotIntent
@@ -20,18 +20,24 @@ def average_intensity(images: np.ndarray, labels: np.ndarray = None, rois: np.nd
     if labels is None and rois is not None:
         labels = get_label_array(images, rois=rois)
 
-        # Trim the image based on labels, and resolve to memory
+        # Trim the image based on labels (frames are only read below, one chunk at a time)
         si, se = np.where(np.flipud(labels))
-        images = np.asarray(images[:, si.min():si.max() + 1, se.min():se.max() + 1])
+        images = images[:, si.min():si.max() + 1, se.min():se.max() + 1]
         labels = np.asarray(np.flipud(labels)[si.min():si.max() + 1, se.min():se.max() + 1])
 
+    # Single pass over the stack; each label's sum comes from one reduction over its (contiguous) pixels. As with
+    # averaging the frame with every other label's pixels zeroed, the sums are averaged over all pixels of the frame
     averages = []
     if labels is not None:
-        n_labels = int(labels.max())
-        for label in range(1, n_labels + 1):
-            masked_image = np.where(labels == label, images, np.zeros(images[0].shape))
-            averages.append(np.average(masked_image, axis=(-2, -1)))
+        pixel_list, offsets = label_pixel_index(labels)
+        nonempty = np.diff(offsets) > 0
+        for chunk in iter_frame_chunks(images):
+            sums = np.zeros((len(chunk), len(nonempty)))
+            sums[:, nonempty] = np.add.reduceat(chunk.reshape(len(chunk), -1)[:, pixel_list],
+                                                offsets[:-1][nonempty], axis=1)
+            averages.append(sums / labels.size)
+        averages = np.concatenate(averages).T
     else:
-        averages = np.average(trimmed_images, axis=(-2, -1))
+        averages = np.concatenate([np.average(chunk, axis=(-2, -1)) for chunk in iter_frame_chunks(images)])
 
     return np.asarray(range(len(images))), np.asarray(averages).squeeze(), images
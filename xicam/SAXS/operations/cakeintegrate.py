@@ -5,9 +5,11 @@ from pyFAI.integrator.azimuthal import AzimuthalIntegrator
 from xicam.plugins.operationplugin import operation, output_names, display_name, describe_input, describe_output, \
     categories
 
+from ..utils import FrameStacks, lazy_frame_map
+
 
 @operation
-@output_names('cake', 'chi', 'q')
+@output_names('cake', 'chi', 'q', 'sigma')
 @display_name("Cake Integrate")
 @describe_input("azimuthal_integrator", 'A PyFAI.AzimuthalIntegrator object')
 @describe_input("data", '2d array representing intensity for each pixel')
@@ -26,9 +28,14 @@ from xicam.plugins.operationplugin import operation, output_names, display_name,
                           '"full_csr", "lut_ocl" and "csr_ocl" if you want to go on GPU. To Specify the device: '
                           '"csr_ocl_1,2"')
 @describe_input("normalization_factor", 'Value of a normalization monitor')
+@describe_input("lazy", 'Cake every frame of an image stack into a dask array whose chunks of frames are only '
+                        'integrated when first computed')
+@describe_input("variance", 'Per-pixel variance of data (of one frame, or of every frame when lazy); defaults to the '
+                            'Poisson variance of raw counts')
 @describe_output("chi", 'Chi bin center positions')
 @describe_output("cake", 'Binned/pixel-split integrated intensity')
 @describe_output("q", 'Q bin center positions')
+@describe_output("sigma", 'Standard error of cake')
 @categories(("Scattering", "Transformations"))
 def cake_integration(azimuthal_integrator: AzimuthalIntegrator,
                      data: np.ndarray,
@@ -42,21 +49,43 @@ def cake_integration(azimuthal_integrator: AzimuthalIntegrator,
                      dark: np.ndarray = None,
                      flat: np.ndarray = None,
                      method: str = 'splitbbox',
-                     normalization_factor: float = 1) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-    cake, q, chi = azimuthal_integrator.integrate2d(data=data,
-                                                    npt_rad=npt_rad,
-                                                    npt_azim=npt_azim,
-                                                    radial_range=radial_range,
-                                                    azimuth_range=azimuth_range,
-                                                    mask=mask,
-                                                    polarization_factor=polz_factor,
-                                                    dark=dark,
-                                                    flat=flat,
-                                                    method=method,
-                                                    unit=unit,
-                                                    normalization_factor=normalization_factor)
+                     normalization_factor: float = 1,
+                     lazy: bool = False,
+                     variance: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    def integrate(frame, frame_variance=variance):
+        return azimuthal_integrator.integrate2d(data=np.asarray(frame),
+                                                npt_rad=npt_rad,
+                                                npt_azim=npt_azim,
+                                                radial_range=radial_range,
+                                                azimuth_range=azimuth_range,
+                                                mask=mask,
+                                                polarization_factor=polz_factor,
+                                                dark=dark,
+                                                flat=flat,
+                                                method=method,
+                                                unit=unit,
+                                                normalization_factor=normalization_factor,
+                                                variance=frame_variance,
+                                                error_model='poisson')
+
+    if lazy:
+        if data.ndim == 2:
+            data = data[None]
+        stacked_variance = variance is not None and np.ndim(variance) == 3
+        frames = FrameStacks(data, variance) if stacked_variance else data
+
+        def integrate_frames(chunk):
+            return [integrate(*frame) for frame in zip(*chunk)] if stacked_variance else list(map(integrate, chunk))
+
+        # The bins only depend on the geometry, so the first frame gives q and chi for the whole stack
+        first = integrate_frames(frames[:1])[0]
+        results = lazy_frame_map(lambda chunk: [(result.intensity, result.sigma) for result in integrate_frames(chunk)],
+                                 frames, (2, npt_azim, npt_rad), np.float32)
+        return results[:, 0], first.radial, first.azimuthal, results[:, 1]
+
+    result = integrate(data)
 
-    return cake, q, chi
+    return result.intensity, result.radial, result.azimuthal, result.sigma
 
 # # TODO: check if the data actually needs to be flipped ud; keeping this for posterity
 # def nonesafe_flipud(data: np.ndarray):
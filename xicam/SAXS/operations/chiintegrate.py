@@ -1,17 +1,24 @@
-from typing import Union, Tuple
+from itertools import repeat
+from typing import List, Union, Tuple
 
-from xicam.core.intents import PlotIntent
 from xicam.plugins.operationplugin import operation, output_names, display_name, describe_input, describe_output, \
     categories, intent
 import numpy as np
 from pyFAI import units
 from pyFAI.integrator.azimuthal import AzimuthalIntegrator
 
+from ..intents import SAXSErrorBarIntent
+from ..utils import FrameStacks, map_frame_chunks
+from ..utils.integration import integrate_chi_frames, integrate_chi_stack
+
 
 @operation
-@output_names("chi", "I")
+@output_names("chi", "I", "sigma")
 @display_name("Chi Integration")
 @describe_input("azimuthal_integrator", 'A PyFAI.AzimuthalIntegrator object')
+@describe_input("geometries", 'One PyFAI.AzimuthalIntegrator per frame, for scans that move the detector or sample; '
+                              'replaces azimuthal_integrator. Frames with identical geometries share an integration '
+                              'engine and the chi output holds one row of bin centers per frame')
 @describe_input("data", '2d array representing intensity for each pixel')
 @describe_input("npt_azim", 'Number of bins along chi')
 @describe_input("polz_factor", 'Polarization factor for correction')
@@ -27,9 +34,16 @@ from pyFAI.integrator.azimuthal import AzimuthalIntegrator
                           '"full_csr", "lut_ocl" and "csr_ocl" if you want to go on GPU. To Specify the device: '
                           '"csr_ocl_1,2"')
 @describe_input('normalization_factor', 'Value of a normalization monitor')
+@describe_input('batched', 'Profile the whole stack at once with a cached chi binning matrix (built once per geometry, '
+                           'mask, npt_azim, unit and range) instead of calling pyFAI\'s 2D integration once per frame')
+@describe_input('workers', 'Number of threads integrating chunks of frames concurrently')
+@describe_input('variance', 'Per-pixel variance of data (of one frame, or of every frame), e.g. from Preprocess Frames; '
+                            'defaults to the Poisson variance of raw counts')
 @describe_output("chi", 'Q bin center positions')
 @describe_output("I", 'Binned/pixel-split integrated intensity')
-@intent(PlotIntent, name="Chi Integrate", output_map={"x": "chi", "y": "I"}, labels={"bottom": "chi", "left": "I"})
+@describe_output("sigma", 'Standard error of I')
+@intent(SAXSErrorBarIntent, name="Chi Integrate", output_map={"x": "chi", "y": "I", "top": "sigma", "bottom": "sigma"},
+        labels={"bottom": "chi", "left": "I"})
 @categories(("Scattering", "Integration"))
 def chi_integrate(azimuthal_integrator: AzimuthalIntegrator,
                   data: np.ndarray,
@@ -42,29 +56,68 @@ def chi_integrate(azimuthal_integrator: AzimuthalIntegrator,
                   dark: np.ndarray = None,
                   flat: np.ndarray = None,
                   method: str = 'splitbbox',
-                  normalization_factor: float = 1, ) -> Tuple[np.ndarray, np.ndarray]:
-    I = []
-    chi = []
-    if data.ndim == 2:
-        data = [data]
-    for frame in data:
-        I_i, q_i, chi_i = azimuthal_integrator.integrate2d(data=np.asarray(frame),
-                                                           npt_rad=1,
-                                                           npt_azim=npt_azim,
-                                                           radial_range=radial_range,
-                                                           azimuth_range=azimuth_range,
-                                                           mask=mask,
-                                                           polarization_factor=polz_factor,
-                                                           dark=dark,
-                                                           flat=flat,
-                                                           method=method,
-                                                           unit=unit,
-                                                           normalization_factor=normalization_factor)
+                  normalization_factor: float = 1,
+                  batched: bool = True,
+                  workers: int = 1,
+                  geometries: List[AzimuthalIntegrator] = None,
+                  variance: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if batched and geometries is not None:
+        return integrate_chi_frames(geometries, data, npt_azim, unit=unit, radial_range=radial_range,
+                                    azimuth_range=azimuth_range, mask=mask, dark=dark, flat=flat,
+                                    polarization_factor=polz_factor, method=method,
+                                    normalization_factor=normalization_factor, workers=workers, variance=variance,
+                                    error_model='poisson')
+    if batched:
+        return integrate_chi_stack(azimuthal_integrator,
+                                   data,
+                                   npt_azim,
+                                   unit=unit,
+                                   radial_range=radial_range,
+                                   azimuth_range=azimuth_range,
+                                   mask=mask,
+                                   dark=dark,
+                                   flat=flat,
+                                   polarization_factor=polz_factor,
+                                   method=method,
+                                   normalization_factor=normalization_factor,
+                                   workers=workers,
+                                   variance=variance,
+                                   error_model='poisson')
+
+    stacked_variance = variance is not None and np.ndim(variance) == 3
 
-        I_i = np.sum(I_i, axis=1)
-        chi.append(chi_i)
-        I.append(I_i)
-    return np.asarray(chi_i), np.asarray(I)  # TODO: support dynamic q
+    def integrate(frames, geometry=azimuthal_integrator):
+        frames, variances = frames if stacked_variance else (frames, repeat(variance))
+        return [geometry.integrate2d(data=np.asarray(frame),
+                                     npt_rad=1,
+                                     npt_azim=npt_azim,
+                                     radial_range=radial_range,
+                                     azimuth_range=azimuth_range,
+                                     mask=mask,
+                                     polarization_factor=polz_factor,
+                                     dark=dark,
+                                     flat=flat,
+                                     method=method,
+                                     unit=unit,
+                                     normalization_factor=normalization_factor,
+                                     variance=frame_variance,
+                                     error_model='poisson')
+                for frame, frame_variance in zip(frames, variances)]
+
+    if data.ndim == 2:
+        data = data[None]
+    frames = FrameStacks(data, variance) if stacked_variance else data
+    if geometries is not None:
+        results = [integrate(frames[index:index + 1], geometry)[0] for index, geometry in enumerate(geometries)]
+    else:
+        results = [result for chunk in map_frame_chunks(integrate, frames, workers=workers) for result in chunk]
+    chi = [result.azimuthal for result in results]
+    I = [np.sum(result.intensity, axis=1) for result in results]
+    sigma = [np.sqrt(np.sum(result.sigma ** 2, axis=1)) for result in results]
+    if geometries is not None:
+        return np.asarray(chi), np.asarray(I), np.asarray(sigma)
+    # Every frame shares the geometry, and so the bins
+    return np.asarray(chi[-1]), np.asarray(I), np.asarray(sigma)
 
 # def nonesafe_flipud(data: np.ndarray):
 #     if data is None: return None
@@ -1,22 +1,61 @@
+import threading
+from collections import OrderedDict
+from functools import partial
+
 import numpy as np
+from dask import array as da
 from numba import njit, prange
-from typing import Iterable, Tuple
+from typing import Iterable, NamedTuple, Tuple
 from xicam.plugins.operationplugin import operation, display_name, output_names, describe_input, \
     describe_output, categories, visible
 import pyqtgraph as pg
-from ..utils import get_label_array
+from .darks import dark_model
+from ..utils import get_label_array, frame_chunk_size
 from xarray import DataArray
 
 
-def correct(array, flats, bkg, gain_map=(1, 2, 4, 8), clip=False):
-    return _correct(np.asarray(array, dtype=np.uint16),
-                    np.asarray(flats, dtype=np.uint16),
-                    np.asarray(bkg, dtype=np.uint16),
-                    clip=clip)
+def correct(array, flats, bkg, gain_map=(1, 2, 4, 8), clip=False, dtype=np.int32):
+    array = np.asarray(array, dtype=np.uint16)
+    tables = correction_tables(flats, bkg, gain_map)
+    out = np.empty(array.shape, dtype=dtype)
+    _correct(array.reshape(-1, array.shape[-1]),
+             tables.flat,
+             tables.dark,
+             tables.threshold,
+             tables.gain_map,
+             out.reshape(-1, out.shape[-1]),
+             clip)
+    return out
 
 
-@njit(parallel=True)
-def _correct(array, flats, bkg, gain_map=(1, 2, 4, 8), clip=False):
+class CorrectionTables(NamedTuple):
+    """Per-pixel lookup tables for the FastCCD correction of a flat/dark pair."""
+    flat: np.ndarray  # masked flat field
+    dark: np.ndarray  # masked dark scaled by the gain encoded in the dark
+    threshold: np.ndarray  # masked dark, below which intensities are clipped
+    gain_map: np.ndarray
+
+
+_CORRECTION_TABLES_CACHE_SIZE = 4
+_correction_tables_cache = OrderedDict()
+_correction_tables_lock = threading.Lock()
+
+
+def correction_tables(flats, bkg, gain_map=(1, 2, 4, 8)) -> CorrectionTables:
+    """Decode the flat and dark frames into correction lookup tables.
+
+    The tables are cached on the identity of the `flats` and `bkg` arrays (and the gain map), so correcting many
+    chunks of frames against the same flat/dark pair only decodes them once; arrays modified in place after use are
+    not detected.
+    """
+    gain_map = tuple(gain_map)
+    key = id(flats), id(bkg), gain_map
+    with _correction_tables_lock:
+        cached = _correction_tables_cache.get(key)
+        if cached is not None and cached[0] is flats and cached[1] is bkg:
+            _correction_tables_cache.move_to_end(key)
+            return cached[2]
+
     # 16-bit unsigned
     # image: bits 0 - 12
     # bad:   bit 13
@@ -24,44 +63,93 @@ def _correct(array, flats, bkg, gain_map=(1, 2, 4, 8), clip=False):
     # gain1: 0b11 (3)
     # gain2: 0b10 (2)
     # gain8: 0b00 (0)
-    masked_flat = 0x1FFF & flats
-    masked_dark = 0x1FFF & bkg
-    out = np.empty_like(array, dtype=np.int32)
-
-    for i in prange(array.shape[0]):
-        for j in prange(array.shape[1]):
-            for k in prange(array.shape[2]):
-                val = array[i, j, k]
+    flats_bits = np.asarray(flats, dtype=np.uint16)
+    bkg_bits = np.asarray(bkg, dtype=np.uint16)
+    gains = np.asarray(gain_map, dtype=np.int32)
+    masked_dark = (0x1FFF & bkg_bits).astype(np.int32)
+    tables = CorrectionTables(flat=(0x1FFF & flats_bits).astype(np.int32),
+                              dark=gains[0x3 & (bkg_bits >> 14)] * masked_dark,
+                              threshold=masked_dark,
+                              gain_map=gains)
+
+    with _correction_tables_lock:
+        _correction_tables_cache[key] = flats, bkg, tables
+        while len(_correction_tables_cache) > _CORRECTION_TABLES_CACHE_SIZE:
+            _correction_tables_cache.popitem(last=False)
+    return tables
 
-                intensity = 0x1FFF & val
-                bad_flag = 0x1 & (val >> 13)
-                gain = gain_map[0x3 & (val >> 14)]
 
-                bkg_gain = gain_map[0x3 & (bkg[j, k] >> 14)]
-
-                out[i, j, k] = masked_flat[j, k] * gain * intensity
-
-                if clip:
-                    if intensity < masked_dark[j, k]:
-                        out[i, j, k] = bkg_gain * masked_dark[j, k]
-
-                if bad_flag:
-                    out[i, j, k] = 0
-                else:
-                    out[i, j, k] -= bkg_gain * masked_dark[j, k]
-
-    return out
-
-
-def reduce_data(images, slices):
-    trimmed_images = []
-    for i in range(len(images)):
-        image = np.asarray(images[i])
-        image = image[slices]
-        trimmed_images.append(image)
-        del image
-
-    return DataArray(np.asarray(trimmed_images))
+@njit(parallel=True)
+def _correct(rows, flat, dark, threshold, gain_map, out, clip):
+    # rows are the image rows of all frames stacked, (num_frames * height, width); one prange over them
+    height, width = flat.shape
+    for r in prange(rows.shape[0]):
+        j = r % height
+        for k in range(width):
+            val = rows[r, k]
+            intensity = 0x1FFF & val
+            value = flat[j, k] * gain_map[0x3 & (val >> 14)] * intensity - dark[j, k]
+            if (0x1 & (val >> 13)) or (clip and intensity < threshold[j, k]):
+                value = 0
+            out[r, k] = value
+
+
+def as_frame_stack(images) -> da.Array:
+    """Dask view of an image stack (numpy, dask or xarray), chunked along the frame axis only."""
+    if isinstance(images, DataArray):
+        images = images.data
+    if not isinstance(images, da.Array):
+        images = da.from_array(images, chunks=(frame_chunk_size(images),) + tuple(images.shape[1:]))
+    return images.rechunk({axis: -1 for axis in range(1, images.ndim)})
+
+
+class CorrectedFrames:
+    """Lazily cropped and corrected view of a FastCCD image stack.
+
+    Frames are only read, cropped and corrected when indexed (the crop is applied to the source stack before it is
+    resolved, so pixels outside of it are never read). Streaming consumers such as `iter_frame_chunks` can pull the
+    stack one chunk at a time without the corrected series ever being materialized.
+    """
+    ndim = 3
+
+    def __init__(self, images, flats, darks, gains=(1, 2, 4, 8), clip=False, slices=(slice(None), slice(None)),
+                 dtype=np.int32):
+        self.images = images
+        self.dtype = np.dtype(dtype)
+        self.flats = np.asarray(flats)
+        self.darks = np.asarray(darks)
+        self.gains = gains
+        self.clip = clip
+        self.slices = slices
+        frame_shape = tuple(len(range(*s.indices(n))) for s, n in zip(slices, images.shape[-2:]))
+        self.shape = (len(images), *frame_shape)
+
+    @property
+    def chunks(self):
+        # Frames are read following the chunking of the source stack
+        chunks = getattr(self.images, 'chunks', None)
+        return (chunks[0],) if chunks else None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if (isinstance(key[0], slice) and key[0] == slice(None) and len(key) == 3
+                and all(isinstance(k, slice) for k in key[1:])):
+            # Cropping the whole stack further stays lazy
+            ranges = [range(*s.indices(n))[k] for s, n, k in zip(self.slices, self.images.shape[-2:], key[1:])]
+            slices = tuple(slice(r.start, r.stop, r.step) for r in ranges)
+            return CorrectedFrames(self.images, self.flats[key[1:]], self.darks[key[1:]], self.gains, self.clip, slices,
+                                   self.dtype)
+
+        frames = np.asarray(self.images[(key[0], *self.slices)])
+        if frames.ndim == 2:
+            return correct(frames[None], self.flats, self.darks, self.gains, self.clip, self.dtype)[0][key[1:]]
+        return correct(frames, self.flats, self.darks, self.gains, self.clip, self.dtype)[(slice(None), *key[1:])]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
 
 
 @operation
@@ -70,12 +158,18 @@ def reduce_data(images, slices):
 @describe_input('flats', '2-dimensional input array containing flat image data')
 @describe_input('darks', '3-dimensional input array containing 2-dimensional dark image data')
 @describe_input('gains', 'n-dimensional input array containing gain values')
+@describe_input('dark_statistic', 'How a stack of darks is reduced to a dark frame: "mean", "median" (approximate) or '
+                                  '"clipped" (mean within 3 standard deviations, rejecting outliers)')
+@describe_input('dtype', 'Data type of the corrected images, "int32" or "float32"')
+@describe_input('fused', 'Defer the crop and correction until downstream operations read the frames, one chunk at '
+                         'a time, instead of materializing the corrected stack')
 @output_names('images', 'labels')
 @describe_output('images', 'Corrected fastccd image data')
 @categories(('Scattering', 'Calibration'))
 @visible('images', False)
 @visible('flats', False)
 @visible('darks', False)
+@visible('fused', False)
 def correct_fastccd_image(images: np.ndarray,
                           flats: np.ndarray = None,
                           darks: np.ndarray = None,
@@ -83,6 +177,9 @@ def correct_fastccd_image(images: np.ndarray,
                           clip_below_dark: bool = False,
                           rois: Iterable[pg.ROI] = None,
                           image_item: pg.ImageItem = None,
+                          dark_statistic: str = 'mean',
+                          dtype: str = 'int32',
+                          fused: bool = False,
                           ) -> Tuple[np.ndarray, np.ndarray]:
     # TODO: is this pulling from the correct dark? we need of mapping of gain index to dark array?
 
@@ -99,29 +196,36 @@ def correct_fastccd_image(images: np.ndarray,
     if darks is None:
         darks = np.zeros_like(images[0])
     elif darks.ndim == 3:
-        darks = np.sum(darks, axis=0) / darks.shape[0]
+        # Streamed per-gain-mode statistics, cached per run
+        darks = dark_model(darks, dark_statistic).dark_frame
     elif darks.ndim == 2:
         pass  # darks is already a single frame
 
+    squeeze = images.ndim == 2
+    images = as_frame_stack(images)
+    if squeeze:
+        images = images[None]
+
     labels = np.zeros((1, *images.shape[-2:]))
     if rois and image_item:
         labels = get_label_array(images, rois=rois, image_item=image_item)
 
-        # Trim the image based on labels, and resolve to memory
+        # Trim the image based on labels; the crop is lazy, so pixels outside of it are never read
         si, se = np.where(np.flipud(labels))
-        # images = np.asarray(images[:, si.min():si.max() + 1, se.min():se.max() + 1])
         slices = slice(si.min(), si.max() + 1), slice(se.min(), se.max() + 1)
-        template = DataArray(np.empty((images.shape[0], si.max() - si.min() + 1, se.max() - se.min() + 1))).chunk(
-            images._variable.data.chunksize)
-        images = images.map_blocks(reduce_data, template=template, kwargs=dict(slices=slices)).compute()
-
-        flats = np.asarray(flats[si.min():si.max() + 1, se.min():se.max() + 1])
-        darks = np.asarray(darks[si.min():si.max() + 1, se.min():se.max() + 1])
-        labels = np.asarray(np.flipud(labels)[si.min():si.max() + 1, se.min():se.max() + 1])
-
-    corrected_images = correct(images,
-                               flats,
-                               darks,
-                               gains,
-                               clip=clip_below_dark)
-    return corrected_images, labels
+        images = images[(slice(None), *slices)]
+        flats = np.asarray(flats[slices])
+        darks = np.asarray(darks[slices])
+        labels = np.asarray(np.flipud(labels)[slices])
+
+    if fused and not squeeze:
+        return CorrectedFrames(images, flats, darks, gains, clip_below_dark, dtype=dtype), labels
+
+    # Each chunk of frames is corrected when it is computed; downstream operations pull frames on demand
+    corrected_images = images.map_blocks(partial(correct, dtype=dtype),
+                                         dtype=np.dtype(dtype),
+                                         flats=np.asarray(flats),
+                                         bkg=np.asarray(darks),
+                                         gain_map=tuple(gains),
+                                         clip=clip_below_dark)
+    return corrected_images[0] if squeeze else corrected_images, labels
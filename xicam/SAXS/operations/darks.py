@@ -0,0 +1,139 @@
+import threading
+import warnings
+from collections import OrderedDict
+from typing import NamedTuple
+
+import numpy as np
+from dask import array as da
+from xarray import DataArray
+
+from ..utils import iter_frame_chunks
+
+# FastCCD pixels carry 2 gain bits (14-15); statistics are kept separately for each gain mode
+GAIN_MODES = 4
+DARK_STATISTICS = ['mean', 'median', 'clipped']
+
+
+class DarkModel(NamedTuple):
+    """Per-pixel statistics of a FastCCD dark stack, separated by gain mode; arrays have shape (GAIN_MODES, H, W)."""
+    intensity: np.ndarray  # dark level (mean, approximate median or clipped mean), NaN where a mode was never seen
+    variance: np.ndarray
+    counts: np.ndarray  # number of (non-bad) dark frames seen in each mode
+
+    @property
+    def dark_frame(self) -> np.ndarray:
+        """uint16 dark frame as used by `correct`: each pixel's most frequent gain mode and its dark level."""
+        mode = np.argmax(self.counts, axis=0)
+        level = np.take_along_axis(self.intensity, mode[None], axis=0)[0]
+        level = np.clip(np.rint(np.nan_to_num(level)), 0, 0x1FFF).astype(np.uint16)
+        return (mode.astype(np.uint16) << 14) | level
+
+
+def _decode(chunk: np.ndarray):
+    # 13-bit intensities, gain mode and a mask of the pixels not flagged bad (bit 13)
+    chunk = np.asarray(chunk, dtype=np.uint16)
+    return (0x1FFF & chunk).astype(np.float64), chunk >> 14, (0x1 & (chunk >> 13)) == 0
+
+
+def build_dark_model(darks, statistic: str = 'mean', sigma: float = 3.0, chunk_size: int = None) -> DarkModel:
+    """Accumulate the dark statistics of a dark stack, reading it one chunk of frames at a time.
+
+    The gain bits are decoded before averaging. "mean" accumulates the mean and variance of each mode in a single
+    pass (combining chunks with Chan's parallel update); "median" additionally takes the median of the per-chunk
+    medians as an approximate median in the same pass; "clipped" makes a second pass averaging only the values
+    within `sigma` standard deviations of the mean, rejecting outlier frames (e.g. cosmic rays).
+    """
+    if statistic not in DARK_STATISTICS:
+        raise ValueError(f'Unknown dark statistic "{statistic}"; expected one of {DARK_STATISTICS}.')
+
+    shape = (GAIN_MODES, *darks.shape[-2:])
+    counts = np.zeros(shape, dtype=np.int64)
+    mean = np.zeros(shape)
+    m2 = np.zeros(shape)
+    medians = [[] for _ in range(GAIN_MODES)]
+
+    for chunk in iter_frame_chunks(darks, chunk_size):
+        intensity, modes, valid = _decode(chunk)
+        for mode in range(GAIN_MODES):
+            in_mode = (modes == mode) & valid
+            n = in_mode.sum(axis=0)
+            if not n.any():
+                continue
+            with np.errstate(divide='ignore', invalid='ignore'):
+                chunk_mean = np.nan_to_num(np.where(in_mode, intensity, 0).sum(axis=0) / n)
+                chunk_m2 = (np.where(in_mode, intensity - chunk_mean, 0) ** 2).sum(axis=0)
+                total = counts[mode] + n
+                delta = chunk_mean - mean[mode]
+                mean[mode] += np.nan_to_num(delta * n / total)
+                m2[mode] += chunk_m2 + np.nan_to_num(delta ** 2 * counts[mode] * n / total)
+            counts[mode] = total
+            if statistic == 'median':
+                with warnings.catch_warnings():
+                    # all-NaN slices (pixels not in this mode for the whole chunk) are expected
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    medians[mode].append(np.nanmedian(np.where(in_mode, intensity, np.nan), axis=0))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = m2 / counts
+    unobserved = counts == 0
+    mean[unobserved] = np.nan
+
+    if statistic == 'median':
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            intensity = np.stack([np.nanmedian(m, axis=0) if m else np.full(shape[1:], np.nan) for m in medians])
+    elif statistic == 'clipped':
+        intensity = _clipped_mean(darks, mean, np.sqrt(variance), sigma, chunk_size)
+    else:
+        intensity = mean
+    return DarkModel(intensity, variance, counts)
+
+
+def _clipped_mean(darks, mean: np.ndarray, std: np.ndarray, sigma: float, chunk_size: int) -> np.ndarray:
+    sums = np.zeros(mean.shape)
+    counts = np.zeros(mean.shape, dtype=np.int64)
+    for chunk in iter_frame_chunks(darks, chunk_size):
+        intensity, modes, valid = _decode(chunk)
+        for mode in range(GAIN_MODES):
+            with np.errstate(invalid='ignore'):
+                kept = (modes == mode) & valid & (np.abs(intensity - mean[mode]) <= sigma * std[mode])
+            sums[mode] += np.where(kept, intensity, 0).sum(axis=0)
+            counts[mode] += kept.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Fall back to the plain mean where every value was clipped
+        return np.where(counts > 0, sums / counts, mean)
+
+
+_DARK_MODEL_CACHE_SIZE = 4
+_dark_model_cache = OrderedDict()
+_dark_model_lock = threading.Lock()
+
+
+def dark_model(darks, statistic: str = 'mean', sigma: float = 3.0, run_uid: str = None) -> DarkModel:
+    """Dark model of a dark stack, cached per run.
+
+    The run is identified by `run_uid`, by the "run_uid" attribute of a DataArray, or else by the name of a
+    dask-backed stack (which is stable for as long as the same lazy stack is reused); stacks with none of these
+    are not cached.
+    """
+    if run_uid is None:
+        run_uid = getattr(darks, 'attrs', {}).get('run_uid')
+    if run_uid is None:
+        data = darks.data if isinstance(darks, DataArray) else darks
+        run_uid = data.name if isinstance(data, da.Array) else None
+    if run_uid is None:
+        return build_dark_model(darks, statistic, sigma)
+
+    key = run_uid, statistic, sigma
+    with _dark_model_lock:
+        model = _dark_model_cache.get(key)
+        if model is not None:
+            _dark_model_cache.move_to_end(key)
+            return model
+
+    model = build_dark_model(darks, statistic, sigma)
+    with _dark_model_lock:
+        _dark_model_cache[key] = model
+        while len(_dark_model_cache) > _DARK_MODEL_CACHE_SIZE:
+            _dark_model_cache.popitem(last=False)
+    return model
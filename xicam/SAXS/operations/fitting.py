@@ -1,6 +1,6 @@
 import numpy as np
 import skbeam.core.correlation as corr
-from astropy.modeling import Fittable1DModel, Parameter, fitting
+from astropy.modeling import Fittable1DModel, Parameter
 from xicam.core.intents import PlotIntent
 
 from xicam.plugins.operationplugin import operation, output_names, display_name, describe_input, describe_output, \
@@ -15,7 +15,10 @@ from typing import Union, Tuple
 @describe_input('tau', 'delay time')
 @describe_input('beta', 'Optical contrast (speckle contrast), a sample-independent beamline parameter')
 @describe_input('baseline', 'baseline of one time correlation equal to one for ergodic samples')
-@describe_input('correlation_threshold', 'threshold defining which g2 values to fit')
+@describe_input('correlation_threshold', 'threshold defining which g2 values to fit; each curve is fit up to its '
+                                         'first value below the threshold')
+@describe_input('fit_beta', 'Also fit the optical contrast (beta) of each curve')
+@describe_input('fit_baseline', 'Also fit the baseline of each curve')
 @describe_output('fit_curve', 'Fitted model of the g2 curve')
 @describe_output('relaxation_rates', 'Relaxation time associated with the samples dynamics')
 @intent(PlotIntent,
@@ -42,18 +45,24 @@ def fit_scattering_factor(g2: np.ndarray,
                           beta: float = 1.0,
                           baseline: float = 1.0,
                           relaxation_rate: float = 0.01,
-                          correlation_threshold: float = 2) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
-    model = ScatteringModel(beta, baseline, relaxation_rate=relaxation_rate)
-    fitting_algorithm = fitting.SLSQPLSQFitter()
-    threshold = min(len(tau), np.argmax(g2 < correlation_threshold))
+                          correlation_threshold: float = 2,
+                          fit_beta: bool = False,
+                          fit_baseline: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    curves = np.atleast_2d(g2)
 
-    if g2.ndim > 1:
-        fits = [fitting_algorithm(model, tau[:threshold], g2[i][:threshold]) for i in range(len(g2))]
-    else:
-        fits = [fitting_algorithm(model, tau[:threshold], g2[:threshold])]
+    # Each curve is fit up to its own first value below the threshold
+    below = curves < correlation_threshold
+    thresholds = np.where(below.any(axis=1), np.argmax(below, axis=1), len(tau))
+    # Curves without any value above the threshold are fit over all of their values
+    thresholds[thresholds == 0] = len(tau)
+    weights = np.arange(len(tau)) < thresholds[:, None]
 
-    relaxation_rates = np.asarray([fit.relaxation_rate.value for fit in fits]).squeeze()
-    fit_curves = np.asarray([fit(tau) for fit in fits]).squeeze()
+    params = batch_fit_scattering_factor(tau, curves, weights, beta, baseline, relaxation_rate,
+                                         fit_beta=fit_beta, fit_baseline=fit_baseline)
+    relaxation_rates, betas, baselines = params.T
+
+    relaxation_rates = relaxation_rates.squeeze()
+    fit_curves = corr.auto_corr_scat_factor(tau, betas[:, None], params[:, :1], baselines[:, None]).squeeze()
 
     return fit_curves, relaxation_rates, tau, g2
 
@@ -64,6 +73,74 @@ def fit_scattering_factor(g2: np.ndarray,
     # self.intents = [CoPlotHint(one_time_hint, fit_hint, name="1-Time")]
 
 
+def batch_fit_scattering_factor(tau: np.ndarray,
+                                g2: np.ndarray,
+                                weights: np.ndarray,
+                                beta: float = 1.0,
+                                baseline: float = 1.0,
+                                relaxation_rate: float = 0.01,
+                                fit_beta: bool = False,
+                                fit_baseline: bool = False,
+                                max_iterations: int = 50,
+                                tolerance: float = 1e-8) -> np.ndarray:
+    """Fit `g2 = baseline + beta * exp(-2 * relaxation_rate * tau)` to many curves at once.
+
+    `g2` and `weights` have shape (num_curves, len(tau)); points with zero weight are ignored. The relaxation rates
+    start from a log-linear least-squares guess (falling back to `relaxation_rate`) and are refined, together with
+    beta and/or the baseline if requested, by Levenberg-Marquardt steps solved for all curves in a single batch.
+
+    Returns an array of shape (num_curves, 3) holding the relaxation rate, beta and baseline of each curve.
+    """
+    weights = np.asarray(weights, dtype=float)
+    num_curves = len(g2)
+    params = np.empty((num_curves, 3))
+    params[:, 1] = beta
+    params[:, 2] = baseline
+    free = [0] + ([1] if fit_beta else []) + ([2] if fit_baseline else [])
+
+    # Log-linear initial guess: log((g2 - baseline) / beta) = -2 * relaxation_rate * tau
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_y = np.log((g2 - baseline) / beta)
+        usable = weights * np.isfinite(log_y)
+        log_y = np.where(usable > 0, log_y, 0)
+        rates = -np.sum(usable * tau * log_y, axis=1) / (2 * np.sum(usable * tau ** 2, axis=1))
+    params[:, 0] = np.where(np.isfinite(rates) & (rates > 0), rates, relaxation_rate)
+
+    def cost(p):
+        residuals = g2 - corr.auto_corr_scat_factor(tau, p[:, 1:2], p[:, :1], p[:, 2:])
+        return np.sum(weights * residuals ** 2, axis=1)
+
+    current_cost = cost(params)
+    damping = np.full(num_curves, 1e-3)
+    converged = np.zeros(num_curves, dtype=bool)
+    for _ in range(max_iterations):
+        decay = np.exp(-2 * params[:, :1] * tau)
+        residuals = g2 - (params[:, 2:] + params[:, 1:2] * decay)
+        jacobian = np.stack([-2 * tau * params[:, 1:2] * decay, decay, np.ones_like(decay)], axis=-1)[..., free]
+
+        jtj = np.einsum('ckp,ck,ckq->cpq', jacobian, weights, jacobian)
+        jtr = np.einsum('ckp,ck,ck->cp', jacobian, weights, residuals)
+        diagonal = np.einsum('cpp->cp', jtj)
+        system = jtj + (damping[:, None] * diagonal + 1e-12)[..., None] * np.eye(len(free))
+        step = np.linalg.solve(system, jtr[..., None])[..., 0]
+
+        trial = params.copy()
+        trial[:, free] += step
+        trial_cost = cost(trial)
+        improved = trial_cost < current_cost
+        params[improved] = trial[improved]
+        damping = np.where(improved, damping / 10, damping * 10)
+
+        # A curve has converged once a successful step barely reduces its cost, or no step succeeds anymore
+        converged |= improved & (current_cost - trial_cost <= tolerance * current_cost)
+        converged |= damping > 1e10
+        current_cost = np.where(improved, trial_cost, current_cost)
+        if converged.all():
+            break
+
+    return params
+
+
 class ScatteringModel(Fittable1DModel):
     inputs = ('tau',)
     outputs = ('g2',)
@@ -1,6 +1,9 @@
 from xicam.plugins.operationplugin import operation, output_names, display_name, describe_input, describe_output, \
-    categories
+    categories, units
 import numpy as np
+from scipy import fft
+
+from ..utils import iter_frame_chunks, label_pixel_index
 
 
 @operation
@@ -11,26 +14,55 @@ import numpy as np
                           'Each ROI is represented by sequential integers starting at one.'
                           'For example, if you have four ROIs, they must be labeled'
                           '1, 2, 3, 4. Background is labeled as 0')
-@describe_output('g2', 'Normalized correlation with shape = (len(lag_steps), num_rois)')
+@describe_input('max_memory', 'Approximate memory budget for the FFT work arrays; labeled pixels are transformed in '
+                              'chunks that fit within it')
+@describe_output('g2', 'Normalized correlation with shape = (num_rois, len(lag_steps))')
+@units('max_memory', 'MB')
 # TODO: intent
 @categories('Scattering', 'Correlation')
 def fourier_correlation(data: np.ndarray,
-                        labels: np.ndarray) -> np.ndarray:
-    data = np.array(data)
-    mask = np.logical_not(1 == labels)
-
-    x = np.asarray(data)
-    N, NX, NY = x.shape
-    x_mean = x.mean(axis=0)
-    x_std = x.std(axis=0)
-    x = x - x_mean
-
-    # zero pad
-    x = np.r_[x, np.zeros((N - 1, NX, NY))]
-    s = np.fft.fft(x, axis=0)
-    result = np.real(np.fft.ifft(s * s.conj(), axis=0))
-    result = result[:N, :, :] / N / x_std
-    g2 = np.ma.average(
-        np.ma.masked_array(np.nan_to_num(result), mask=np.broadcast_to(mask, (result.shape[0],) + mask.shape)),
-        axis=(1, 2)).data
-    return g2
+                        labels: np.ndarray,
+                        max_memory: int = 1024) -> np.ndarray:
+    # Only the labeled pixels are correlated; they are ordered by label so each chunk covers contiguous label ranges
+    pixel_list, offsets = label_pixel_index(labels)
+    num_labels = len(offsets) - 1
+    pixel_counts = np.diff(offsets)
+    pixel_labels = np.repeat(np.arange(1, num_labels + 1), pixel_counts)
+
+    N = len(data)
+    # zero pad to a fast FFT length of at least 2N - 1 so the circular correlation equals the linear one
+    n_fft = fft.next_fast_len(2 * N - 1, real=True)
+    # per pixel: the gathered float32 series, its float64 copy, its padded real FFT and the inverse transform
+    bytes_per_pixel = 4 * N + 8 * N + 16 * (n_fft // 2 + 1) + 8 * n_fft
+    pixels_per_chunk = max(1, int(max_memory * 2 ** 20 // bytes_per_pixel))
+
+    sums = np.zeros((num_labels + 1, N))
+    for start in range(0, len(pixel_list), pixels_per_chunk):
+        stop = start + pixels_per_chunk
+        # Gather only this chunk of pixels; the frames are read once per pixel chunk (once if everything fits)
+        chunk_pixels = pixel_list[start:stop]
+        x = np.empty((N, len(chunk_pixels)), dtype=np.float32)
+        offset = 0
+        for frames in iter_frame_chunks(data):
+            x[offset:offset + len(frames)] = frames.reshape(len(frames), -1)[:, chunk_pixels]
+            offset += len(frames)
+
+        x_chunk = x.astype(np.float64)
+        x_std = x_chunk.std(axis=0)
+        x_chunk -= x_chunk.mean(axis=0)
+
+        s = fft.rfft(x_chunk, n=n_fft, axis=0)
+        result = fft.irfft(s * s.conj(), n=n_fft, axis=0)[:N]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = np.nan_to_num(result / N / x_std)
+
+        # Accumulate per-label sums over the (sorted) pixels of this chunk
+        chunk_labels = pixel_labels[start:stop]
+        boundaries = np.flatnonzero(np.diff(chunk_labels)) + 1
+        label_sums = np.add.reduceat(result, np.concatenate([[0], boundaries]), axis=1)
+        sums[chunk_labels[np.concatenate([[0], boundaries])]] += label_sums.T
+
+    # Labels without any pixels have no correlation; they are left at 0
+    g2 = np.zeros((num_labels, N))
+    np.divide(sums[1:], pixel_counts[:, None], out=g2, where=pixel_counts[:, None] > 0)
+    return g2.squeeze()
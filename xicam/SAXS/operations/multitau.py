@@ -0,0 +1,187 @@
+from itertools import islice
+from typing import Iterable, Tuple
+
+import numpy as np
+from numba import njit, prange
+from skbeam.core.utils import multi_tau_lags
+
+# operation kinds in a multi-tau schedule
+_WRITE_FRAME, _WRITE_AVERAGE, _CORRELATE = 0, 1, 2
+
+
+def numba_multi_tau_auto_corr(num_levels: int,
+                              num_bufs: int,
+                              labels: np.ndarray,
+                              images: Iterable[np.ndarray],
+                              chunk_size: int = 64) -> Tuple[np.ndarray, np.ndarray]:
+    """Drop-in replacement for `skbeam.core.correlation.multi_tau_auto_corr` parallelized with numba.
+
+    `images` may be a 3-dimensional array or any iterable of frames (e.g. a generator streaming a dask stack); frames
+    are processed `chunk_size` at a time.
+    """
+    correlator = MultiTauCorrelator(num_levels, num_bufs, labels)
+    images = iter(images)
+    while True:
+        chunk = list(islice(images, chunk_size))
+        if not chunk:
+            break
+        correlator.update(np.asarray(chunk))
+    return correlator.result()
+
+
+class MultiTauCorrelator:
+    """Multi-tau one-time correlator whose buffer updates run in parallel across labels and pixels.
+
+    Implements the same algorithm (and symmetric normalization) as `skbeam.core.correlation.lazy_one_time`. The order
+    in which ring-buffer slots are written and correlated only depends on the number of frames seen, so it is first
+    laid out serially as a schedule for each chunk of frames; the schedule is then replayed independently for blocks
+    of ROI pixels with `prange`. Frames are held in float32 ring buffers while the correlation sums are accumulated in
+    float64 per pixel block and reduced per label at the end.
+    """
+    def __init__(self, num_levels: int, num_bufs: int, labels: np.ndarray, block_size: int = 1024):
+        if num_bufs % 2 != 0:
+            raise ValueError(f"There must be an even number of `num_bufs`. You provided {num_bufs}")
+        self.num_levels = num_levels
+        self.num_bufs = num_bufs
+        _, self.lag_steps, _ = multi_tau_lags(num_levels, num_bufs)
+
+        # Map labels onto sequential integers starting at 1 and order the pixels by label
+        flat_labels = np.ravel(labels)
+        pixel_list = np.flatnonzero(flat_labels)
+        _, label_array = np.unique(flat_labels[pixel_list], return_inverse=True)
+        order = np.argsort(label_array, kind='stable')
+        self.pixel_list = pixel_list[order]
+        label_array = label_array[order]
+        self.num_pixels = np.bincount(label_array)
+
+        # Split each label's pixels into blocks; each block is one unit of parallel work
+        bounds = np.concatenate([[0], np.cumsum(self.num_pixels)])
+        starts = [np.arange(start, stop, block_size) for start, stop in zip(bounds[:-1], bounds[1:])]
+        self.block_starts = np.concatenate(starts + [[len(self.pixel_list)]]).astype(np.int64)
+        self.block_labels = np.concatenate([np.full(len(s), label) for label, s in enumerate(starts)]).astype(np.int64)
+
+        num_lags = len(self.lag_steps)
+        num_blocks = len(self.block_labels)
+        self.buf = np.zeros((num_levels, num_bufs, len(self.pixel_list)), dtype=np.float32)
+        self.G = np.zeros((num_blocks, num_lags))
+        self.past_intensity = np.zeros((num_blocks, num_lags))
+        self.future_intensity = np.zeros((num_blocks, num_lags))
+
+        # Schedule state
+        self.cur = np.ones(num_levels, dtype=np.int64)
+        self.img_per_level = np.zeros(num_levels, dtype=np.int64)
+        self.track_level = np.zeros(num_levels, dtype=np.bool_)
+        self.bad_slots = np.zeros((num_levels, num_bufs), dtype=np.bool_)
+        self.counts = np.zeros(num_lags, dtype=np.int64)
+
+    def update(self, frames: np.ndarray):
+        """Correlate the next chunk of frames."""
+        frames = np.asarray(frames).reshape(len(frames), -1)[:, self.pixel_list].astype(np.float32)
+        bad_frames = np.isnan(frames).any(axis=1)
+        max_ops = len(frames) * (1 + self.num_bufs + (self.num_levels - 1) * (1 + self.num_bufs // 2))
+        ops = np.empty((max_ops, 5), dtype=np.int64)
+        num_ops = _schedule(bad_frames, self.num_levels, self.num_bufs, self.cur, self.img_per_level,
+                            self.track_level, self.bad_slots, self.counts, ops)
+        _replay(frames, ops[:num_ops], self.buf, self.block_starts, self.G, self.past_intensity,
+                self.future_intensity)
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Normalized g2 with shape (len(lag_steps), num_rois) and the lag steps, as in `multi_tau_auto_corr`."""
+        num_labels = len(self.num_pixels)
+        sums = []
+        for accumulator in (self.G, self.past_intensity, self.future_intensity):
+            per_label = np.zeros((num_labels, accumulator.shape[1]))
+            np.add.at(per_label, self.block_labels, accumulator)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sums.append((per_label / self.num_pixels[:, None] / self.counts).T)
+        G, past_intensity, future_intensity = (np.nan_to_num(s) for s in sums)
+
+        # Lags that have not been reached yet can't be normalized
+        unreached = np.where(past_intensity == 0)[0]
+        g_max = unreached[0] if len(unreached) else past_intensity.shape[0]
+        g2 = G[:g_max] / (past_intensity[:g_max] * future_intensity[:g_max])
+        return g2, self.lag_steps[:g_max]
+
+
+@njit
+def _schedule(bad_frames, num_levels, num_bufs, cur, img_per_level, track_level, bad_slots, counts, ops):
+    # Lays out the buffer writes and correlations of the multi-tau algorithm for a chunk of frames; modifies the
+    # schedule state in place and returns the number of operations written to `ops`
+    num_ops = 0
+    for frame in range(len(bad_frames)):
+        cur[0] = (1 + cur[0]) % num_bufs
+        slot = (cur[0] - 1) % num_bufs
+        num_ops = _add_op(ops, num_ops, _WRITE_FRAME, 0, slot, frame, 0)
+        bad_slots[0, slot] = bad_frames[frame]
+        num_ops = _schedule_level(0, slot, num_bufs, img_per_level, bad_slots, counts, ops, num_ops)
+
+        level = 1
+        processing = num_levels > 1
+        while processing:
+            if not track_level[level]:
+                track_level[level] = True
+                processing = False
+            else:
+                prev = (cur[level - 1] - 2) % num_bufs
+                last = (cur[level - 1] - 1) % num_bufs
+                cur[level] = 1 + cur[level] % num_bufs
+                slot = cur[level] - 1
+                num_ops = _add_op(ops, num_ops, _WRITE_AVERAGE, level, slot, prev, last)
+                bad_slots[level, slot] = bad_slots[level - 1, prev] or bad_slots[level - 1, last]
+                track_level[level] = False
+                num_ops = _schedule_level(level, slot, num_bufs, img_per_level, bad_slots, counts, ops, num_ops)
+                level += 1
+                processing = level < num_levels
+    return num_ops
+
+
+@njit
+def _schedule_level(level, buf_no, num_bufs, img_per_level, bad_slots, counts, ops, num_ops):
+    img_per_level[level] += 1
+    # subsequent levels only correlate the upper half of their buffers
+    i_min = num_bufs // 2 if level else 0
+    for i in range(i_min, min(img_per_level[level], num_bufs)):
+        t_index = level * num_bufs // 2 + i
+        delay_no = (buf_no - i) % num_bufs
+        # pairs involving bad (NaN) frames are left out of the averages
+        if not (bad_slots[level, delay_no] or bad_slots[level, buf_no]):
+            num_ops = _add_op(ops, num_ops, _CORRELATE, level, t_index, delay_no, buf_no)
+            counts[t_index] += 1
+    return num_ops
+
+
+@njit
+def _add_op(ops, num_ops, kind, level, slot, a, b):
+    ops[num_ops, 0] = kind
+    ops[num_ops, 1] = level
+    ops[num_ops, 2] = slot
+    ops[num_ops, 3] = a
+    ops[num_ops, 4] = b
+    return num_ops + 1
+
+
+@njit(parallel=True)
+def _replay(frames, ops, buf, block_starts, G, past_intensity, future_intensity):
+    for block in prange(len(block_starts) - 1):
+        start, stop = block_starts[block], block_starts[block + 1]
+        for op in range(len(ops)):
+            kind, level, slot, a, b = ops[op, 0], ops[op, 1], ops[op, 2], ops[op, 3], ops[op, 4]
+            if kind == _WRITE_FRAME:
+                for p in range(start, stop):
+                    buf[0, slot, p] = frames[a, p]
+            elif kind == _WRITE_AVERAGE:
+                for p in range(start, stop):
+                    buf[level, slot, p] = (buf[level - 1, a, p] + buf[level - 1, b, p]) / 2
+            else:
+                g = 0.
+                past = 0.
+                future = 0.
+                for p in range(start, stop):
+                    past_value = buf[level, a, p]
+                    future_value = buf[level, b, p]
+                    g += past_value * future_value
+                    past += past_value
+                    future += future_value
+                G[block, slot] += g
+                past_intensity[block, slot] += past
+                future_intensity[block, slot] += future
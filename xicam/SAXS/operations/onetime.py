@@ -1,6 +1,6 @@
 import numpy as np
 from dask import array as da
-from typing import Tuple, List, Iterable
+from typing import Callable, Tuple, List, Iterable
 import pyqtgraph as pg
 
 import skbeam.core.correlation as corr
@@ -11,13 +11,19 @@ from xicam.core import msg
 from xicam.plugins.operationplugin import operation, describe_input, describe_output, visible, \
     input_names, output_names, display_name, categories, intent
 
-from ..utils import get_label_array, average_q_from_labels
+from .multitau import numba_multi_tau_auto_corr
+from ..utils import get_label_array, average_q_from_labels, iter_frame_chunks
+
+
+# Multi-tau correlators by engine name; both take (num_levels, num_bufs, labels, images) and return (g2, tau)
+ONE_TIME_ENGINES = {'numpy': corr.multi_tau_auto_corr,
+                    'numba': numba_multi_tau_auto_corr}
 
 
 @operation
 @display_name('1-time Correlation')
 @input_names('images', 'labels', 'rois', 'image_item', 'number_of_buffers', 'number_of_levels',
-             'intensity_drift_correction')
+             'intensity_drift_correction', 'streaming', 'chunk_size', 'engine')
 @describe_input('images', 'Input array of two or more dimensions')
 @describe_input('labels', 'Labeled array of the same shape as the image stack. \
                  Each ROI is represented by sequential integers starting at one.  For \
@@ -28,6 +34,12 @@ from ..utils import get_label_array, average_q_from_labels
 @describe_input('number_of_levels', 'Integer number defining how many generations of \
                  downsampling to perform, i.e., the depth of the binomial tree \
                  of averaged frames')
+@describe_input('streaming', 'Read the image stack one chunk of frames at a time instead of resolving the whole \
+                 series into memory; peak memory scales with the multi-tau buffers rather than the number of frames')
+@describe_input('chunk_size', 'Number of frames read per chunk when streaming; defaults to the dask chunking of \
+                 the image stack')
+@describe_input('engine', 'Multi-tau correlator: "numpy" (scikit-beam) or "numba" (parallel across labels and \
+                 pixels, with float32 accumulators)')
 @output_names('g2', 'tau', 'images', 'labels')
 @describe_output('g2', 'Normalized g2 data array with shape = (len(lag_steps), num_rois)')
 @describe_output('tau', 'array describing tau (lag steps)')
@@ -35,6 +47,7 @@ from ..utils import get_label_array, average_q_from_labels
 @visible('labels', False)
 @visible('rois', False)
 @visible('image_item', False)
+@visible('chunk_size', False)
 @intent(PlotIntent,
         match_key='1-time Correlation',
         name='g2',
@@ -48,7 +61,14 @@ def one_time_correlation(images: np.ndarray,
                          image_item: pg.ImageItem = None,
                          num_bufs: int = 16,
                          num_levels: int = 8,
-                         intensity_drift_correction: bool = True) -> Tuple[da.array, da.array, da.array, np.ndarray]:
+                         intensity_drift_correction: bool = True,
+                         streaming: bool = False,
+                         chunk_size: int = None,
+                         engine: str = 'numpy') -> Tuple[da.array, da.array, da.array, np.ndarray]:
+    if engine not in ONE_TIME_ENGINES:
+        raise ValueError(f"Unknown one-time correlation engine {engine!r}; expected one of {list(ONE_TIME_ENGINES)}.")
+    correlate = ONE_TIME_ENGINES[engine]
+
     if images.ndim < 3:
         raise ValueError(f"Cannot compute correlation on data with {images.ndim} dimensions.")
 
@@ -59,28 +79,89 @@ def one_time_correlation(images: np.ndarray,
             msg.notifyMessage("Please add an ROI over which to calculate one-time correlation.")
             raise ValueError("Please add an ROI over which to calculate one-time correlation.")
 
-        # Trim the image based on labels, and resolve to memory
+        # Trim the image based on labels
         si, se = np.where(np.flipud(labels))
-        # trimmed_images = np.asarray(images[:, si.min():si.max() + 1, se.min():se.max() + 1])
-        trimmed_images = np.asarray([image[si.min():si.max() + 1, se.min():se.max() + 1] for image in images])
-        trimmed_labels = np.asarray(np.flipud(labels)[si.min():si.max() + 1, se.min():se.max() + 1])
+        slices = (slice(si.min(), si.max() + 1), slice(se.min(), se.max() + 1))
+        trimmed_labels = np.asarray(np.flipud(labels)[slices])
+
+        if streaming:
+            g2, tau = streaming_multi_tau_auto_corr(images, trimmed_labels, num_levels, num_bufs,
+                                                    intensity_drift_correction, slices, chunk_size, correlate)
+            return g2, tau, images, labels
+
+        # Resolve to memory; the (lazy) stack is cropped first so that pixels outside of the ROIs are never read
+        trimmed_images = np.concatenate([chunk.astype(np.float64)
+                                         for chunk in iter_frame_chunks(images[(slice(None), *slices)])])
 
 
     # If a labels array is passed in, no trimming is done; autocorr should read each frame lazy-like
     else:
-        trimmed_images = images
+        if streaming:
+            g2, tau = streaming_multi_tau_auto_corr(images, labels, num_levels, num_bufs,
+                                                    intensity_drift_correction, chunk_size=chunk_size,
+                                                    correlate=correlate)
+            return g2, tau, images, labels
+
+        trimmed_images = np.array(images, dtype=np.float64)
         trimmed_labels = labels
 
     # trimmed_images[trimmed_images <= 0] = np.NaN   # may be necessary to mask values
 
+    # trimmed_images is a private float copy of the frames; normalize it in place
     if intensity_drift_correction:
-        trimmed_images = trimmed_images / np.mean(trimmed_images, axis=(1, 2))[:, None, None]
+        trimmed_images /= np.mean(trimmed_images, axis=(1, 2))[:, None, None]
 
     trimmed_images -= np.min(trimmed_images, axis=0)
 
-    g2, tau = corr.multi_tau_auto_corr(num_levels, num_bufs,
-                                       trimmed_labels.astype(np.uint8),
-                                       trimmed_images)
+    g2, tau = correlate(num_levels, num_bufs,
+                        trimmed_labels.astype(np.uint8),
+                        trimmed_images)
     g2 = g2[1:].squeeze()
     # FIXME: is it required to trim the 0th value off the tau and g2 arrays?
     return g2.T, tau[1:], images, labels
+
+
+def streaming_multi_tau_auto_corr(images,
+                                  labels: np.ndarray,
+                                  num_levels: int,
+                                  num_bufs: int,
+                                  intensity_drift_correction: bool = True,
+                                  slices: Tuple[slice, slice] = (slice(None), slice(None)),
+                                  chunk_size: int = None,
+                                  correlate: Callable = corr.multi_tau_auto_corr) -> Tuple[np.ndarray, np.ndarray]:
+    """Multi-tau one-time correlation that reads `images` one chunk of frames at a time.
+
+    Two passes are made over the stack: the first collects the per-frame means (for intensity drift correction) and
+    the per-pixel minimum, the second feeds the normalized frames into the multi-tau buffers of `correlate` (the
+    generator-based `skbeam.core.correlation.multi_tau_auto_corr` by default). Only a single chunk of frames is ever
+    resolved into memory, so the result matches the in-memory path of `one_time_correlation` while peak memory is
+    bounded by the chunk size and the `num_levels * num_bufs * roi_pixels` buffers. The stack is cropped to `slices`
+    before it is read, so lazy stacks never resolve the pixels outside of them.
+    """
+    images = images[(slice(None), *slices)]
+
+    # First pass: per-frame means and per-pixel minimum of the (drift corrected) frames
+    means = []
+    minimum = None
+    for chunk in iter_frame_chunks(images, chunk_size):
+        if intensity_drift_correction:
+            chunk_means = np.mean(chunk, axis=(1, 2))
+            means.append(chunk_means)
+            chunk = chunk / chunk_means[:, None, None]
+        chunk_minimum = np.min(chunk, axis=0)
+        minimum = chunk_minimum if minimum is None else np.minimum(minimum, chunk_minimum)
+    if intensity_drift_correction:
+        means = np.concatenate(means)
+
+    # Second pass: stream the normalized frames through the multi-tau buffers
+    def normalized_frames():
+        offset = 0
+        for chunk in iter_frame_chunks(images, chunk_size):
+            if intensity_drift_correction:
+                chunk = chunk / means[offset:offset + len(chunk), None, None]
+            offset += len(chunk)
+            yield from chunk - minimum
+
+    g2, tau = correlate(num_levels, num_bufs, labels.astype(np.uint8), normalized_frames())
+    g2 = g2[1:].squeeze()
+    return g2.T, tau[1:]
@@ -0,0 +1,84 @@
+from functools import partial
+from typing import Tuple
+
+import numpy as np
+from dask import array as da
+from pyFAI.integrator.azimuthal import AzimuthalIntegrator
+from xarray import DataArray
+from xicam.plugins.operationplugin import operation, output_names, display_name, describe_input, describe_output, \
+    categories
+
+from .correction import as_frame_stack
+from ..utils import iter_frame_chunks
+
+
+def _correct_frames(chunk, offset: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    return (np.asarray(chunk, dtype=np.float32) - offset) * scale
+
+
+def _frame_variance(chunk, scale: np.ndarray) -> np.ndarray:
+    # Poisson variance of the raw counts (as in pyFAI), scaled as the frames are
+    return np.maximum(np.asarray(chunk, dtype=np.float32), 1) * scale ** 2
+
+
+@operation
+@display_name('Preprocess Frames')
+@output_names('data', 'mask', 'variance')
+@describe_input('data', 'Image stack (or single frame)')
+@describe_input('azimuthal_integrator', 'A PyFAI.AzimuthalIntegrator object; its detector mask is merged into the '
+                                        'output mask')
+@describe_input('mask', 'Array (same size as image) with 1 for masked pixels, and 0 for valid pixels')
+@describe_input('dark', 'Dark noise image')
+@describe_input('flat', 'Flat field image')
+@describe_input('normalization_factor', 'Value of a normalization monitor')
+@describe_output('data', 'float32 frames, dark-subtracted and divided by the flat and the normalization factor; '
+                         'masked pixels are zero')
+@describe_output('mask', 'Combined mask of the input mask, the detector mask and the pixels with an invalid flat or '
+                         'dark (1 for masked pixels)')
+@describe_output('variance', 'Per-pixel Poisson variance of the output frames, propagated through the corrections; '
+                             'lazy for image stacks, so it is only computed chunk by chunk as it is read')
+@categories(('Scattering', 'Calibration'))
+def preprocess_frames(data: np.ndarray,
+                      azimuthal_integrator: AzimuthalIntegrator = None,
+                      mask: np.ndarray = None,
+                      dark: np.ndarray = None,
+                      flat: np.ndarray = None,
+                      normalization_factor: float = 1) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # The corrections are folded into a per-pixel offset and scale, applied to each chunk of frames once so that the
+    # reductions downstream share the corrected frames instead of each correcting (and reading) them again
+    shape = tuple(data.shape[-2:])
+    combined_mask = np.zeros(shape, dtype=bool) if mask is None else np.array(mask, dtype=bool)
+    detector = getattr(azimuthal_integrator, 'detector', None)
+    if getattr(detector, 'mask', None) is not None and detector.mask.shape == shape:
+        combined_mask |= np.asarray(detector.mask, dtype=bool)
+
+    offset = np.zeros(shape, dtype=np.float32) if dark is None else np.array(dark, dtype=np.float32)
+    scale = np.full(shape, 1 / normalization_factor, dtype=np.float32)
+    combined_mask |= ~np.isfinite(offset)
+    if flat is not None:
+        flat = np.asarray(flat, dtype=np.float32)
+        combined_mask |= ~(np.isfinite(flat) & (flat > 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale /= flat
+    offset[combined_mask] = 0
+    scale[combined_mask] = 0
+
+    correct_frames = partial(_correct_frames, offset=offset, scale=scale)
+    frame_variance = partial(_frame_variance, scale=scale)
+    if isinstance(data, (da.Array, DataArray)):
+        # Lazy stacks stay lazy; frames are corrected as their chunks are computed
+        stack = as_frame_stack(data)
+        return (stack.map_blocks(correct_frames, dtype=np.float32), combined_mask,
+                stack.map_blocks(frame_variance, dtype=np.float32))
+
+    if data.ndim == 2:
+        return correct_frames(data), combined_mask, frame_variance(data)
+
+    corrected = np.empty(data.shape, dtype=np.float32)
+    start = 0
+    for chunk in iter_frame_chunks(data):
+        corrected[start:start + len(chunk)] = correct_frames(chunk)
+        start += len(chunk)
+    # The variance is derived from the raw frames chunk by chunk as the integrations read it, rather than held as a
+    # second full stack next to the corrected frames
+    return corrected, combined_mask, as_frame_stack(data).map_blocks(frame_variance, dtype=np.float32)
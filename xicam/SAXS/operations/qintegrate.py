@@ -1,16 +1,23 @@
-from xicam.core.intents import PlotIntent
 from xicam.plugins.operationplugin import operation, output_names, display_name, describe_input, describe_output, \
     categories, intent
 import numpy as np
-from typing import Tuple, Union
+from itertools import repeat
+from typing import List, Tuple, Union
 from pyFAI import units
 from pyFAI.integrator.azimuthal import AzimuthalIntegrator
 
+from ..intents import SAXSErrorBarIntent
+from ..utils import FrameStacks, lazy_frame_map, map_frame_chunks
+from ..utils.integration import integrate1d_frames, integrate1d_stack
+
 
 @operation
 @display_name('q Integration')
-@output_names('q', 'I')
+@output_names('q', 'I', 'sigma')
 @describe_input('azimuthal_integrator', 'A PyFAI.AzimuthalIntegrator object')
+@describe_input('geometries', 'One PyFAI.AzimuthalIntegrator per frame, for scans that move the detector or sample; '
+                              'replaces azimuthal_integrator. Frames with identical geometries share an integration '
+                              'engine, the q output holds one row of bin centers per frame and results are not lazy')
 @describe_input('data', '2d array representing intensity for each pixel')
 @describe_input('npt', 'Number of bins along q')
 @describe_input('polz_factor', 'Polarization factor for correction')
@@ -26,9 +33,18 @@ from pyFAI.integrator.azimuthal import AzimuthalIntegrator
                           '"full_csr", "lut_ocl" and "csr_ocl" if you want to go on GPU. To Specify the device: '
                           '"csr_ocl_1,2"')
 @describe_input('normalization_factor', 'Value of a normalization monitor')
+@describe_input('batched', 'Integrate the whole stack at once with a cached sparse integration matrix (built once per '
+                           'geometry, mask, npt, unit and range) instead of calling pyFAI once per frame')
+@describe_input('workers', 'Number of threads integrating chunks of frames concurrently')
+@describe_input('lazy', 'Return the intensities as a dask array whose chunks of frames are only integrated when first '
+                        'computed')
+@describe_input('variance', 'Per-pixel variance of data (of one frame, or of every frame), e.g. from Preprocess Frames; '
+                            'defaults to the Poisson variance of raw counts')
 @describe_output('q', 'Q bin center positions')
 @describe_output('I', 'Binned/pixel-split integrated intensity')
-@intent(PlotIntent, name="q Integration", output_map={'x': 'q', 'y': 'I'}, labels={'bottom': 'q', 'left': 'I'})
+@describe_output('sigma', 'Standard error of I')
+@intent(SAXSErrorBarIntent, name="q Integration", output_map={'x': 'q', 'y': 'I', 'top': 'sigma', 'bottom': 'sigma'},
+        labels={'bottom': 'q', 'left': 'I'})
 @categories(("Scattering", "Integration"))
 def q_integrate(azimuthal_integrator: AzimuthalIntegrator,
                 data: np.ndarray,
@@ -41,25 +57,73 @@ def q_integrate(azimuthal_integrator: AzimuthalIntegrator,
                 dark: np.ndarray = None,
                 flat: np.ndarray = None,
                 method: str = 'splitbbox',
-                normalization_factor: float = 1, ) -> Tuple[np.ndarray, np.ndarray]:
-    q = []
-    I = []
+                normalization_factor: float = 1,
+                batched: bool = True,
+                workers: int = 1,
+                geometries: List[AzimuthalIntegrator] = None,
+                lazy: bool = False,
+                variance: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if batched and geometries is not None:
+        return integrate1d_frames(geometries, data, npt, unit=unit, radial_range=radial_range,
+                                  azimuth_range=azimuth_range, mask=mask, dark=dark, flat=flat,
+                                  polarization_factor=polz_factor, method=method,
+                                  normalization_factor=normalization_factor, workers=workers, variance=variance,
+                                  error_model='poisson')
+    if batched:
+        return integrate1d_stack(azimuthal_integrator,
+                                 data,
+                                 npt,
+                                 unit=unit,
+                                 radial_range=radial_range,
+                                 azimuth_range=azimuth_range,
+                                 mask=mask,
+                                 dark=dark,
+                                 flat=flat,
+                                 polarization_factor=polz_factor,
+                                 method=method,
+                                 normalization_factor=normalization_factor,
+                                 workers=workers,
+                                 lazy=lazy,
+                                 variance=variance,
+                                 error_model='poisson')
+
+    stacked_variance = variance is not None and np.ndim(variance) == 3
+
+    def integrate(frames, geometry=azimuthal_integrator):
+        frames, variances = frames if stacked_variance else (frames, repeat(variance))
+        return [geometry.integrate1d(data=np.asarray(frame),
+                                     npt=npt,
+                                     radial_range=radial_range,
+                                     azimuth_range=azimuth_range,
+                                     mask=mask,
+                                     polarization_factor=polz_factor,
+                                     dark=dark,
+                                     flat=flat,
+                                     method=method,
+                                     unit=unit,
+                                     normalization_factor=normalization_factor,
+                                     variance=frame_variance,
+                                     error_model='poisson')
+                for frame, frame_variance in zip(frames, variances)]
+
     if data.ndim == 2:
-        data = [data]
-    for frame in data:
-        q_i, I_i = azimuthal_integrator.integrate1d(data=np.asarray(frame),
-                                                    npt=npt,
-                                                    radial_range=radial_range,
-                                                    azimuth_range=azimuth_range,
-                                                    mask=mask,
-                                                    polarization_factor=polz_factor,
-                                                    dark=dark,
-                                                    flat=flat,
-                                                    method=method,
-                                                    unit=unit,
-                                                    normalization_factor=normalization_factor)
-        q.append(q_i)
-        I.append(I_i)
+        data = data[None]
+    frames = FrameStacks(data, variance) if stacked_variance else data
+    if geometries is not None:
+        results = [integrate(frames[index:index + 1], geometry)[0] for index, geometry in enumerate(geometries)]
+        return (np.asarray([result.radial for result in results]),
+                np.asarray([result.intensity for result in results]),
+                np.asarray([result.sigma for result in results]))
+    if lazy:
+        # The bins only depend on the geometry, so the first frame gives q for the whole stack
+        q = integrate(frames[:1])[0].radial
+        results = lazy_frame_map(lambda chunk: [(result.intensity, result.sigma) for result in integrate(chunk)],
+                                 frames, (2, npt), np.float32)
+        return np.asarray(q), results[:, 0], results[:, 1]
+    results = [result for chunk in map_frame_chunks(integrate, frames, workers=workers) for result in chunk]
+    q = [result.radial for result in results]
+    I = [result.intensity for result in results]
+    sigma = [result.sigma for result in results]
 
-    # TODO: support dynamic q
-    return np.asarray(q_i), np.asarray(I)
+    # Every frame shares the geometry, and so the bins
+    return np.asarray(q[-1]), np.asarray(I), np.asarray(sigma)
@@ -8,7 +8,11 @@ from skbeam.core.correlation import two_time_corr
 from typing import Tuple, Iterable
 
 from ..patches.pyFAI import AzimuthalIntegrator
-from ..utils import average_q_from_labels, get_label_array
+from ..utils import average_q_from_labels, get_label_array, iter_frame_chunks, frame_chunk_size, label_pixel_index
+
+STORAGE_MODES = ['dense', 'triangular', 'resampled']
+STORAGE_DESCRIPTION = ('How the two-time maps are stored: "dense" (num_rois, N, N) arrays, or "triangular", which '
+                       'packs only one triangle of each symmetric map behind a lazy array view')
 
 
 @operation
@@ -64,9 +68,265 @@ def two_time_correlation(images: np.ndarray,
                          num_frames,
                          num_bufs,
                          num_levels)
-    g2 = corr.g2
-    lag_steps = corr.lag_steps
+    # skbeam computes the dense maps; the compact storage modes are only offered by the matrix-multiply engine
+    g2, qs = _two_time_outputs(corr.g2, labels, geometry)
+    return g2, corr.lag_steps, qs
+
+
+@operation
+@display_name('2-time Correlation (Matrix Multiply)')
+@describe_input('images', 'dimensions are: (rr, cc), iterable of 2D arrays')
+@describe_input('chunk_size', 'Number of frames read per chunk and number of rows per tile of the correlation matrix; '
+                              'defaults to the dask chunking of the image stack')
+@describe_input('storage', STORAGE_DESCRIPTION)
+@output_names('g2', 'tau', 'qs')
+@describe_output('g2', 'the normalized correlation shape is (num_rois, num_frames, num_frames)')
+@describe_output('tau', 'the times at which the correlation was computed')
+@visible('images', False)
+@visible('rois', False)
+@visible('chunk_size', False)
+@intent(ImageIntent,
+        name='2-time Correlation',
+        output_map={'image': 'g2', 'xvals': 'qs'},
+        mixins=["AxesLabels", "XArrayView", "SliceSelector"],
+        labels={"bottom": "𝜏₁", "left": "𝜏₂"})
+def matmul_two_time_correlation(images: np.ndarray,
+                                image_item: pg.ImageItem = None,
+                                rois: Iterable[pg.ROI] = None,
+                                chunk_size: int = None,
+                                storage: str = 'dense',
+                                geometry: AzimuthalIntegrator = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if storage not in ('dense', 'triangular'):
+        # Resampled maps have age and lag axes; they are produced by age_lag_two_time_correlation
+        raise ValueError(f'Unknown two-time storage "{storage}"; expected "dense" or "triangular".')
+    labels = get_label_array(images, rois=rois, image_item=image_item)
+    if labels.max() == 0:
+        msg.notifyMessage("Please add an ROI over which to calculate two-time correlation.")
+        raise ValueError("Please add an ROI over which to calculate two-time correlation.")
+
+    g2, lag_steps = matmul_two_time_corr(labels, images, chunk_size, storage=storage)
+
+    g2, qs = _two_time_outputs(g2, labels, geometry)
+    return g2, lag_steps, qs
+
+
+@operation
+@display_name('2-time Correlation (Age/Lag)')
+@describe_input('images', 'dimensions are: (rr, cc), iterable of 2D arrays')
+@describe_input('chunk_size', 'Number of frames read per chunk and number of rows per tile of the correlation matrix; '
+                              'defaults to the dask chunking of the image stack')
+@describe_input('resample_bins', 'Number of age bins, and the maximum number of (logarithmic) lag bins')
+@output_names('g2', 'lag', 'age', 'qs', 'scale')
+@describe_output('g2', 'the normalized correlation binned onto an age by lag grid, shape is '
+                       '(num_rois, resample_bins, len(lag))')
+@describe_output('lag', 'the lag (in frames) at the center of each lag bin')
+@describe_output('age', 'the age (mean of the two frame times) at the center of each age bin')
+@describe_output('scale', 'size of the lag and age bins in image units, used to place the map on its age axis')
+@visible('images', False)
+@visible('rois', False)
+@visible('chunk_size', False)
+@intent(ImageIntent,
+        name='2-time Correlation (Age/Lag)',
+        output_map={'image': 'g2', 'xvals': 'qs', 'scale': 'scale'},
+        mixins=["AxesLabels", "XArrayView", "SliceSelector"],
+        labels={"bottom": "lag bin", "left": "age"})
+def age_lag_two_time_correlation(images: np.ndarray,
+                                 image_item: pg.ImageItem = None,
+                                 rois: Iterable[pg.ROI] = None,
+                                 chunk_size: int = None,
+                                 resample_bins: int = 64,
+                                 geometry: AzimuthalIntegrator = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                                                                                np.ndarray, np.ndarray]:
+    labels = get_label_array(images, rois=rois, image_item=image_item)
+    if labels.max() == 0:
+        msg.notifyMessage("Please add an ROI over which to calculate two-time correlation.")
+        raise ValueError("Please add an ROI over which to calculate two-time correlation.")
+
+    # Each map is binned tile by tile as it is computed, so the dense (N, N) maps are never allocated
+    g2, lag = matmul_two_time_corr(labels, images, chunk_size, storage='resampled', resample_bins=resample_bins)
+
+    age_edges = np.linspace(0, len(images) - 1, resample_bins + 1)
+    age = (age_edges[:-1] + age_edges[1:]) / 2
+    # Lag bins widen logarithmically, so the lag axis counts bins (see the "lag" output for their centers); age bins
+    # are uniform and are scaled onto frames
+    scale = np.array([1, age_edges[1] - age_edges[0]])
+    g2, qs = _two_time_outputs(g2, labels, geometry, rotate=False)
+    return g2, lag, age, qs, scale
+
+
+def matmul_two_time_corr(labels: np.ndarray,
+                         images,
+                         chunk_size: int = None,
+                         dtype=np.float32,
+                         storage: str = 'dense',
+                         resample_bins: int = 64) -> Tuple[np.ndarray, np.ndarray]:
+    """Normalized two-time correlation computed as a matrix product over the ROI pixels of each label.
 
+    The ROI pixels are gathered into a `(frames x npix)` matrix per label while streaming over the image stack one
+    chunk at a time, so only the labeled pixels are ever held in memory. For each label with pixel matrix X, the
+    two-time map is then
+
+        g2 = npix * (X @ X.T) / outer(X.sum(1), X.sum(1))
+
+    which is the same normalization as `skbeam.core.correlation.two_time_corr` with a single level and one buffer per
+    frame. The product is evaluated in tiles of `chunk_size` rows over the lower triangle only, bounding the temporary
+    memory and halving the work. Each tile is written out according to `storage` (see `STORAGE_MODES`), so the
+    "triangular" and "resampled" modes never allocate the dense (N, N) maps.
+
+    Returns the two-time maps and the lag steps (the lag bin centers for "resampled" storage).
+    """
+    if storage not in STORAGE_MODES:
+        raise ValueError(f'Unknown two-time storage "{storage}"; expected one of {STORAGE_MODES}.')
+
+    pixel_list, offsets = label_pixel_index(labels)
+    num_labels = len(offsets) - 1
+    pixel_lists = np.split(pixel_list, offsets[1:-1])
+
+    num_frames = len(images)
+    roi_pixels = [np.empty((num_frames, len(pixel_list)), dtype=dtype) for pixel_list in pixel_lists]
+    offset = 0
+    for chunk in iter_frame_chunks(images, chunk_size):
+        chunk = chunk.reshape(len(chunk), -1)
+        for x, pixel_list in zip(roi_pixels, pixel_lists):
+            x[offset:offset + len(chunk)] = chunk[:, pixel_list]
+        offset += len(chunk)
+
+    # Per-frame normalization vectors
+    intensities = [x.sum(axis=1, dtype=np.float64).astype(dtype) for x in roi_pixels]
+
+    lag_steps = np.arange(num_frames)
+    if storage == 'dense':
+        g2 = np.empty((num_labels, num_frames, num_frames), dtype=dtype)
+    elif storage == 'triangular':
+        g2 = TriangularTwoTime(np.empty((num_labels, num_frames * (num_frames + 1) // 2), dtype=dtype), num_frames)
+    else:
+        resampler = _AgeLagResampler(num_labels, num_frames, resample_bins)
+
+    tile = frame_chunk_size(images, chunk_size)
+    for start in range(0, num_frames, tile):
+        stop = min(start + tile, num_frames)
+        for label, (x, intensity) in enumerate(zip(roi_pixels, intensities)):
+            block = x[start:stop] @ x[:stop].T
+            with np.errstate(divide='ignore', invalid='ignore'):
+                block *= x.shape[1]
+                block /= intensity[start:stop, None]
+                block /= intensity[None, :stop]
+
+            if storage == 'dense':
+                g2[label, start:stop, :stop] = block
+                g2[label, :start, start:stop] = block[:, :start].T
+            elif storage == 'triangular':
+                g2.set_rows(label, start, block)
+            else:
+                resampler.add(label, start, block)
+
+    if storage == 'resampled':
+        g2, lag_steps = resampler.result()
+    return g2, lag_steps
+
+
+class TriangularTwoTime:
+    """Array-like, read-only view of symmetric two-time maps that stores only their lower triangles.
+
+    The triangles are packed row by row into a `(num_labels, N * (N + 1) / 2)` array, half the size of the dense
+    maps. Indexing with `[label, rows, cols]` reconstructs only the requested tile, so image canvases can read the maps
+    tile by tile; `np.asarray` expands the full dense maps. When `rotated` is set the view presents the maps rotated
+    90 degrees, matching the dense output of the two-time operations.
+    """
+    def __init__(self, packed: np.ndarray, num_frames: int, rotated: bool = False):
+        self.packed = packed
+        self.num_frames = num_frames
+        self.rotated = rotated
+
+    def set_rows(self, label: int, start: int, block: np.ndarray):
+        """Store rows `start:start + len(block)` of the lower triangle of a label's map from a (rows x N) block."""
+        for row in range(start, start + len(block)):
+            offset = row * (row + 1) // 2
+            self.packed[label, offset:offset + row + 1] = block[row - start, :row + 1]
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return self.packed.shape[0], self.num_frames, self.num_frames
+
+    @property
+    def dtype(self):
+        return self.packed.dtype
+
+    @property
+    def ndim(self) -> int:
+        return 3
+
+    @property
+    def nbytes(self) -> int:
+        return self.packed.nbytes
+
+    def __len__(self):
+        return self.packed.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            index = key.index(Ellipsis)
+            key = key[:index] + (slice(None),) * (4 - len(key)) + key[index + 1:]
+        key = key + (slice(None),) * (3 - len(key))
+
+        labels, rows, cols = (np.arange(size)[k] for size, k in zip(self.shape, key))
+        a, b = np.atleast_1d(rows)[:, None], np.atleast_1d(cols)[None, :]
+        if self.rotated:
+            a, b = b, self.num_frames - 1 - a
+        i, j = np.maximum(a, b), np.minimum(a, b)
+        index = i * (i + 1) // 2 + j
+
+        tile = np.stack([self.packed[label][index] for label in np.atleast_1d(labels)])
+        # Drop the axes that were indexed with integers
+        return tile[tuple(0 if np.ndim(k) == 0 else slice(None) for k in (labels, rows, cols))]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+class _AgeLagResampler:
+    """Accumulates lower-triangle tiles of two-time maps onto a linear age by logarithmic lag grid.
+
+    Age is (t1 + t2) / 2 and lag is |t1 - t2|; the first lag bins hold single lags, after which bin widths grow
+    geometrically up to the number of frames.
+    """
+    def __init__(self, num_labels: int, num_frames: int, num_bins: int):
+        self.lag_edges = np.unique(np.concatenate([[0], np.round(np.geomspace(1, num_frames, num_bins))])).astype(int)
+        self.age_edges = np.linspace(0, num_frames - 1, num_bins + 1)
+        self.num_lags = len(self.lag_edges) - 1
+        self.num_ages = num_bins
+        self.sums = np.zeros((num_labels, self.num_ages * self.num_lags))
+        self.counts = np.zeros(self.num_ages * self.num_lags)
+        self._tile = None
+
+    def add(self, label: int, start: int, block: np.ndarray):
+        # The bin indices only depend on the tile position; reuse them across labels
+        if self._tile is None or self._tile[0] != (start, block.shape):
+            rows = np.arange(start, start + block.shape[0])[:, None]
+            cols = np.arange(block.shape[1])[None, :]
+            valid = cols <= rows
+            lag_bins = np.searchsorted(self.lag_edges, (rows - cols)[valid], side='right') - 1
+            age_bins = np.clip(np.searchsorted(self.age_edges, ((rows + cols) / 2)[valid], side='right') - 1,
+                               0, self.num_ages - 1)
+            bins = age_bins * self.num_lags + lag_bins
+            self._tile = ((start, block.shape), valid, bins)
+            self.counts += np.bincount(bins, minlength=self.counts.size)
+        _, valid, bins = self._tile
+        self.sums[label] += np.bincount(bins, weights=block[valid], minlength=self.counts.size)
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            g2 = self.sums / self.counts
+        lag_centers = (self.lag_edges[:-1] + self.lag_edges[1:] - 1) / 2
+        return g2.reshape(-1, self.num_ages, self.num_lags), lag_centers
+
+
+def _two_time_outputs(g2,
+                      labels: np.ndarray,
+                      geometry: AzimuthalIntegrator = None,
+                      rotate: bool = True) -> Tuple[np.ndarray, np.ndarray]:
     # Calculate avg qs from label array for first dimension on returned g2 (so slice selector shows qs for indexing)
     qs = None
     if geometry is not None:
@@ -80,9 +340,13 @@ def two_time_correlation(images: np.ndarray,
         #  ValueError: different number of dimensions on data and dims: 2 vs 1
 
     # Rotate image plane 90 degrees
-    g2 = np.rot90(g2, axes=(-2, -1))
+    if rotate:
+        if isinstance(g2, TriangularTwoTime):
+            g2.rotated = True
+        else:
+            g2 = np.rot90(g2, axes=(-2, -1))
 
     num_labels = g2.shape[0]  # first dimension represents labels
-    if not qs:
+    if qs is None:
         qs = np.array(list(range(1, num_labels + 1)))
-    return g2, lag_steps, qs
+    return g2, qs
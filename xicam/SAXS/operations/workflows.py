@@ -1,4 +1,5 @@
 from xicam.core.execution.workflow import Workflow
+from .preprocess import preprocess_frames
 from .qintegrate import q_integrate
 from .chiintegrate import chi_integrate
 from .xintegrate import x_integrate
@@ -7,16 +8,38 @@ from .cakeintegrate import cake_integration
 
 
 class ReduceWorkflow(Workflow):
+    """Preprocesses the frames once and integrates the corrected frames along q, chi, x and z.
+
+    The dark, flat and normalization factor are only applied by the preprocessing, which divides the dark-subtracted
+    frames by the flat. The x and z integrations of the corrected frames are therefore not rescaled by the mean flat
+    response, unlike x/z integrations given a dark and flat themselves. The q integration is lazy by default, so that
+    its frames are integrated as they are viewed (or filled in) rather than before any result is shown.
+    """
+    # Inputs that are only given to the preprocessing, so that the integrations don't apply them a second time
+    preprocessed_inputs = ('dark', 'flat', 'normalization_factor')
+
     def __init__(self):
         super(ReduceWorkflow, self).__init__('Reduce')
 
-        self.qintegrate = q_integrate()
+        # Corrects each frame once and feeds the corrected frames and the combined mask to all of the integrations
+        self.preprocess = preprocess_frames()
+        self.qintegrate = q_integrate(lazy=True)
         self.chiintegrate = chi_integrate()
         self.xintegrate = x_integrate()
         self.zintegrate = z_integrate()
+        self.integrations = (self.qintegrate, self.chiintegrate, self.xintegrate, self.zintegrate)
 
-        self.add_operations(self.qintegrate, self.chiintegrate, self.xintegrate, self.zintegrate)
+        self.add_operations(self.preprocess, *self.integrations)
         self.auto_connect_all()
+        for operation in self.integrations:
+            for name in self.preprocessed_inputs:
+                operation.visible[name] = False
+
+    def fill_kwargs(self, **kwargs):
+        super(ReduceWorkflow, self).fill_kwargs(**{key: value for key, value in kwargs.items()
+                                                   if key not in self.preprocessed_inputs})
+        self.preprocess.filled_values.update({key: value for key, value in kwargs.items()
+                                              if key in self.preprocessed_inputs})
 
 
 class DisplayWorkflow(Workflow):
@@ -1,49 +1,52 @@
-from typing import Tuple
+from typing import List, Tuple
 
-from xicam.core.intents import PlotIntent
 from xicam.plugins.operationplugin import operation, output_names, display_name, describe_input, describe_output, \
     categories, intent
 import numpy as np
 from pyFAI.integrator.azimuthal import AzimuthalIntegrator
 
+from ..intents import SAXSErrorBarIntent
+from ..utils.integration import integrate_lines, line_q, line_q_frames, line_weights
+
 
 @operation
 @display_name("X Integration")
-@output_names("q_x", "I")
+@output_names("q_x", "I", "sigma")
 @describe_input("azimuthal_integrator", 'A PyFAI.AzimuthalIntegrator object')
+@describe_input('geometries', 'One PyFAI.AzimuthalIntegrator per frame, for scans that move the detector or sample; '
+                              'replaces azimuthal_integrator, and the q_x output holds one row per frame')
 @describe_input("data", '2d array representing intensity for each pixel')
 @describe_input("mask", 'Array (same size as image) with 1 for masked pixels, and 0 for valid pixels')
 @describe_input('dark', 'Dark frame image')
 @describe_input('flat', 'Flat field image')
 @describe_input('normalization_factor', 'Value of a normalization monitor')
+@describe_input('workers', 'Number of threads integrating chunks of frames concurrently')
+@describe_input('variance', 'Per-pixel variance of data (of one frame, or of every frame), e.g. from Preprocess Frames; '
+                            'defaults to the Poisson variance of raw counts')
 @describe_output('q_x', "q_x bin center positions")
 @categories(('Scattering', 'Integration'))
-@intent(PlotIntent, name='X Integration', output_map={'x': 'q_x', 'y': 'I'}, labels={'bottom': 'q_x', 'left': 'I'})
-@describe_output('I', 'Binned/pixel-split integrated intensity')
+@intent(SAXSErrorBarIntent, name='X Integration', output_map={'x': 'q_x', 'y': 'I', 'top': 'sigma', 'bottom': 'sigma'},
+        labels={'bottom': 'q_x', 'left': 'I'})
+@describe_output('I', 'Intensity summed along each column, dark-subtracted and weighted by mean(flat - dark) / '
+                      '(flat - dark) with a flat; frames from Preprocess Frames (as in the Reduce workflow) are '
+                      'divided by the flat instead, without the mean flat response')
+@describe_output('sigma', 'Standard error of I')
 def x_integrate(azimuthal_integrator: AzimuthalIntegrator,
                 data: np.ndarray,
                 mask: np.ndarray = None,
                 dark: np.ndarray = None,
                 flat: np.ndarray = None,
-                normalization_factor: float = 1) -> Tuple[np.ndarray, np.ndarray]:
-    if data.ndim == 2:
-        data = [data]
-    if dark is None: dark = np.zeros_like(data[0])
-    if flat is None: flat = np.ones_like(data[0])
-    if mask is None: mask = np.zeros_like(data[0])
-    I = []
-    q_x = []
-    for frame in data:
-        frame = np.asarray(frame)
-        I_i = np.sum((frame - dark) * np.average(flat - dark) / (flat - dark) / normalization_factor * np.logical_not(mask),
-                     axis=-2)
-        I.append(I_i)
-        centerx = azimuthal_integrator.getFit2D()['centerX']
-        centerz = azimuthal_integrator.getFit2D()['centerY']
-        q_x_i = azimuthal_integrator.qFunction(np.array([centerz] * frame.shape[-1]),
-                                               np.arange(0, frame.shape[-1])) / 10.
-        q_x_i[np.arange(0, frame.shape[-1]) < centerx] *= -1.
-        q_x.append(q_x_i)
-
-        # TODO: support dynamic q
-    return np.asarray(q_x_i), np.asarray(I)
+                normalization_factor: float = 1,
+                workers: int = 1,
+                variance: np.ndarray = None,
+                geometries: List[AzimuthalIntegrator] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    shape = tuple(data.shape[-2:])
+    weights = line_weights(shape, mask, dark, flat, normalization_factor)
+    I, sigma = integrate_lines(data, axis=-2, weights=weights, dark=dark, workers=workers, variance=variance,
+                               error_model='poisson')
+    if geometries is not None:
+        if len(geometries) != len(I):
+            raise ValueError(f'Expected one geometry per frame; got {len(geometries)} geometries for {len(I)} frames.')
+        # Summing along the lines does not depend on the geometry; only the q of each frame does
+        return line_q_frames(geometries, shape, axis=-1), I, sigma
+    return line_q(azimuthal_integrator, shape, axis=-1), I, sigma
@@ -1,4 +1,71 @@
+import atexit
+import copy
+import threading
+from multiprocessing import shared_memory
+from typing import NamedTuple, Tuple
+
+import numpy as np
 from pyFAI.integrator import azimuthal
+
+
+class SharedArrayHandle(NamedTuple):
+    """Reference to an array in shared memory; pickled in place of the array itself."""
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+# Shared memory blocks created or attached by this process, by name; the created ones are unlinked at exit
+_shared_blocks = {}
+_owned_blocks = set()
+_shared_lock = threading.Lock()
+
+
+def share_array(array: np.ndarray) -> Tuple[np.ndarray, SharedArrayHandle]:
+    """Copy an array into a new shared memory block; returns the shared copy and its handle.
+
+    Shared arrays are left writeable since pyFAI's Cython engines require writeable buffers, but must not be modified.
+    """
+    array = np.asarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, array.dtype, buffer=block.buf)
+    shared[...] = array
+    with _shared_lock:
+        _shared_blocks[block.name] = block
+        _owned_blocks.add(block.name)
+    return shared, SharedArrayHandle(block.name, array.shape, array.dtype.str)
+
+
+def attach_array(handle: SharedArrayHandle) -> np.ndarray:
+    """Array backed by a shared memory block; each block is attached once per process."""
+    with _shared_lock:
+        block = _shared_blocks.get(handle.name)
+        if block is None:
+            try:
+                # Only the creating process may unlink the block
+                block = shared_memory.SharedMemory(name=handle.name, track=False)
+            except TypeError:  # Python < 3.13
+                block = shared_memory.SharedMemory(name=handle.name)
+            _shared_blocks[handle.name] = block
+    return np.ndarray(handle.shape, handle.dtype, buffer=block.buf)
+
+
+@atexit.register
+def release_shared_arrays():
+    """Unlink the shared memory blocks created by this process.
+
+    Arrays already attached stay valid, but integrators pickled with handles to these blocks can no longer be
+    unpickled.
+    """
+    with _shared_lock:
+        for name in _owned_blocks:
+            try:
+                _shared_blocks[name].unlink()
+            except FileNotFoundError:
+                pass
+        _owned_blocks.clear()
+
+
 # import numpy
 #
 # import logging
@@ -27,41 +94,86 @@ from pyFAI.integrator import azimuthal
 class AzimuthalIntegrator(azimuthal.AzimuthalIntegrator):
 
     def __deepcopy__(self, memo=None):
-        """deep copy
+        """deep copy that shares cached arrays and integration engines with the original
         :param memo: dict with modified objects
-        :return: a deep copy of itself."""
-        numerical = ["_dist", "_poni1", "_poni2", "_rot1", "_rot2", "_rot3",
-                     "chiDiscAtPi", "_dssa_order", "_wavelength",
-                     '_oversampling', '_correct_solid_angle_for_spline',
-                     '_transmission_normal',
-                     ]
+        :return: a deep copy of itself.
+
+        The cached pixel-coordinate arrays (2theta, chi, q, solid angle, ...) and engines only depend on the geometry,
+        which the copy starts out with unchanged, so they are shared rather than recomputed. Each copy gets its own
+        dicts (copy-on-write): changing the geometry of one copy resets only its own caches."""
         if memo is None:
             memo = {}
         new = self.__class__()
         memo[id(self)] = new
-        new_det = self.detector.__deepcopy__(memo)
-        new.detector = new_det
+        new.detector = copy.deepcopy(self.detector, memo)
 
-        for key in numerical:
-            old_value = self.__getattribute__(key)
+        for key in self._IMMUTABLE_ATTRS:
+            old_value = getattr(self, key)
             memo[id(old_value)] = old_value
-            new.__setattr__(key, old_value)
+            setattr(new, key, old_value)
         new_param = [new._dist, new._poni1, new._poni2,
                      new._rot1, new._rot2, new._rot3]
         memo[id(self.param)] = new_param
         new.param = new_param
-        cached = {}
-        memo[id(self._cached_array)] = cached
-        try:
-            for key, old_value in self._cached_array.copy().items():
-                if "copy" in dir(old_value):
-                    new_value = old_value.copy()
-                    memo[id(old_value)] = new_value
-            new._cached_array = cached
-        except Exception:
-            print('huh?')
+        new._empty = self._empty
+
+        new._cached_array = self._cached_array.copy()
+        memo[id(self._cached_array)] = new._cached_array
+        new._shared_handles = dict(getattr(self, '_shared_handles', {}))
+        with self._lock:
+            new.engines = self.engines.copy()
+        memo[id(self.engines)] = new.engines
         return new
 
+    def reset_engines(self, collect_garbage=None):
+        """Drop the integration engines of this integrator.
+
+        Unlike pyFAI, the engines are not reset in place since copies may still be using them; they are freed once no
+        copy refers to them anymore."""
+        with self._lock:
+            self.engines = {}
+        self.collect_garbage(collect_garbage)
+
+    def share_cached_arrays(self):
+        """Move the cached arrays into shared memory, so that pickles carry handles to them instead of their data.
+
+        Processes unpickling the integrator then map the same memory instead of recomputing the arrays. Arrays cached
+        after this call are only shared by calling it again; see `release_shared_arrays`."""
+        handles = dict(getattr(self, '_shared_handles', {}))
+        for key, value in list(self._cached_array.items()):
+            if isinstance(value, np.ndarray) and handles.get(key, (None,))[0] is not value:
+                shared, handle = share_array(value)
+                self._cached_array[key] = shared
+                handles[key] = shared, handle
+        self._shared_handles = handles
+
+    def __getstate__(self):
+        """Compact pickling: only the geometry is sent, along with handles to any shared cached arrays.
+
+        Other cached arrays are dropped and recomputed on demand, as are the engines."""
+        state = super().__getstate__()
+        state.pop('_shared_handles', None)
+        handles = getattr(self, '_shared_handles', {})
+        shared = {key: handles[key][1] for key, value in self._cached_array.items()
+                  if key in handles and handles[key][0] is value}
+        # Scalars cached alongside an array (e.g. "solid_angle#3.0_crc") are kept with it
+        shared.update({key: value for key, value in self._cached_array.items()
+                       if not isinstance(value, np.ndarray) and key.rsplit('_crc', 1)[0] in shared})
+        state['_cached_array'] = shared
+        return state
+
+    def __setstate__(self, state):
+        cached = state.pop('_cached_array', {})
+        super().__setstate__(state)
+        self._cached_array = {}
+        self._shared_handles = {}
+        for key, value in cached.items():
+            if isinstance(value, SharedArrayHandle):
+                array = attach_array(value)
+                self._shared_handles[key] = array, value
+                value = array
+            self._cached_array[key] = value
+
 #     def create_mask(self, data, mask=None,
 #                     dummy=None, delta_dummy=None, mode="normal"):
 #         """
@@ -46,6 +46,31 @@ def extract_mapped_value(run_catalog, projection, key):
         return projection['projection'][key]['value']
 
 
+def per_event_values(values) -> np.ndarray:
+    """One scalar per event of a linked (per-event) value; using max() to get a scalar from each event's reading."""
+    values = np.asarray(values, dtype=float)
+    return values.reshape(len(values), -1).max(axis=1) if values.ndim else values.reshape(1)
+
+
+def event_geometries(positions: np.ndarray, sdd: float, detector) -> list:
+    """One geometry per event from its (poni1, poni2, detector rotation, wavelength) row.
+
+    Events at identical positions share a single geometry object, so that they also share its cached arrays and
+    integration engines.
+    """
+    shared = {}
+    for poni1, poni2, rot2, wavelength in map(tuple, positions):
+        if (poni1, poni2, rot2, wavelength) not in shared:
+            shared[poni1, poni2, rot2, wavelength] = \
+                AzimuthalIntegrator(dist=sdd,
+                                    poni1=poni1,
+                                    poni2=poni2,
+                                    rot2=-np.radians(rot2),  # Convert to radians, account for upward rotation
+                                    detector=detector,
+                                    wavelength=wavelength)
+    return [shared[tuple(position)] for position in positions]
+
+
 def project_NXsas(run_catalog):
     projection = next(
         filter(lambda projection: projection['name'] == PROJECTION_NAME, run_catalog.metadata['start']['projections']),
@@ -60,6 +85,8 @@ def project_NXsas(run_catalog):
     device_name = projection['projection'][DATA_PROJECTION_KEY]['field']
     try:
         darks = run_catalog.dark.to_dask()[device_name]
+        # Lets the dark model of this run be cached across workflow executions
+        darks.attrs['run_uid'] = run_catalog.metadata['start']['uid']
     except (AttributeError, KeyError) as e:
         darks = None
         msg.logMessage(e, level=msg.WARNING)
@@ -81,39 +108,35 @@ def project_NXsas(run_catalog):
 
         wavelength = 1.239842e-6 / beamline_energy  # convert from eV to meters
 
-        # TODO: handle dynamic poni values
         poni1 = projection['configuration']['poni1'] - detector_translate_x
         poni2 = projection['configuration']['poni2'] - detector_translate_y
 
         sdd = projection['configuration']['sdd']
 
-        # These are static values, take first one; using max() to get scalar value
-        poni1 = poni1[0].values.max()
-        rot2 = detector_rotation[0].values.max()
-        wavelength = wavelength[0].values.max()
-        incidence_angle = incidence_angle[0].values.max()
-
         # Create detector from projection metadata
         detector_name = projection['configuration']['detector_name']
         detector_class = ALL_DETECTORS[detector_name]
         detector = detector_class()
 
-        # Convert poni from pixel to meters
-        poni1 *= detector.get_pixel1()
-        poni2 *= detector.get_pixel2()
+        # The positions are recorded per event (frame); scans may move the detector or sample from frame to frame
+        positions = np.stack(np.broadcast_arrays(per_event_values(poni1) * detector.get_pixel1(),  # pixels to meters
+                                                 per_event_values(poni2) * detector.get_pixel2(),
+                                                 per_event_values(detector_rotation),
+                                                 per_event_values(wavelength)), axis=1)
+        incidence_angles = per_event_values(incidence_angle)
+        geometries = event_geometries(positions, sdd, detector)
 
-        geometry = AzimuthalIntegrator(dist=sdd,
-                                       poni1=poni1,
-                                       poni2=poni2,
-                                       rot2=-np.radians(rot2),  # Convert to radians, account for upward rotation
-                                       detector=detector,
-                                       wavelength=wavelength)
+        # The first frame's values describe the run as a whole
+        geometry = geometries[0]
+        incidence_angle = incidence_angles[0]
+        if len(set(map(id, geometries))) == 1:
+            geometries = None
 
 
         calibration_settings.setAI(geometry, device_name)
 
     except (AttributeError, KeyError) as e:
-        geometry = None
+        geometry = geometries = None
         msg.logMessage(e, level=msg.WARNING)
 
     if geometry is None and device_name in calibration_settings.AIs:
@@ -125,6 +148,7 @@ def project_NXsas(run_catalog):
                                               darks=darks,
                                               name=f"GISAXS 〈{run_catalog.metadata['start']['sample_name']}〉",
                                               geometry=geometry,
+                                              geometries=geometries,
                                               incidence_angle=incidence_angle,
                                               match_key=uuid.uuid4(),
                                               device_name=device_name), )
@@ -133,6 +157,7 @@ def project_NXsas(run_catalog):
                                             darks=darks,
                                             name=f"SAXS 〈{run_catalog.metadata['start']['sample_name']}〉",
                                             geometry=geometry,
+                                            geometries=geometries,
                                             match_key=uuid.uuid4(),
                                             device_name=device_name))
 
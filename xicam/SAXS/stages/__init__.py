@@ -27,6 +27,7 @@ from xicam.SAXS.masking.workflows import MaskingWorkflow
 from xicam.SAXS.operations.workflows import DisplayWorkflow, ReduceWorkflow
 from xicam.SAXS.projectors.edf import project_NXsas
 from xicam.SAXS.projectors.nxcansas import project_nxcanSAS
+from xicam.SAXS.utils import compute_lazy_frames
 from xicam.SAXS.widgets.SAXSViewerPlugin import QLabel
 from xicam.SAXS.workflows.xpcs import OneTime, TwoTime
 
@@ -82,6 +83,9 @@ class BaseSAXSGUIPlugin(EnsembleGUIPlugin):
                   'image_item': canvas.canvas_widget.imageItem,
                   'geometry': intents[image_index].geometry}
 
+        if intents[image_index].geometries is not None:
+            kwargs['geometries'] = intents[image_index].geometries
+
         if 'darks' in intents[image_index].kwargs:
             kwargs['darks'] = np.squeeze(intents[image_index].kwargs['darks'])
 
@@ -236,6 +240,8 @@ class ReduceGUIPlugin(BaseSAXSGUIPlugin):
         return kwargs
 
     def append_reduced(self, *results):
+        # Lazily integrated results are ingested as they are: viewers compute the frames they show on demand, while the
+        # remaining blocks are filled in (one block at a time) off the GUI thread
         document = list(ingest_result_set(self.reduceworkflow, results))
         # TODO: do we want to keep in memory catalog or write to attached databroker?
         # FIXME: use better bluesky_live design instead of upserting directly
@@ -243,6 +249,11 @@ class ReduceGUIPlugin(BaseSAXSGUIPlugin):
         catalog.upsert(document[0][1], document[-1][1], partial(iter, document), [], {})
         self.appendCatalog(catalog[-1])
 
+        self._fill_thread = threads.QThreadFuture(compute_lazy_frames,
+                                                  [value for result in results for value in result.values()],
+                                                  showBusy=False)
+        self._fill_thread.start()
+
 
 class CalibrateGUIPlugin(BaseSAXSGUIPlugin):
     name = "Calibrate"
@@ -0,0 +1,17 @@
+import numpy as np
+from dask import array as da
+
+from xicam.SAXS.operations.average_intensity import average_intensity
+
+
+def test_average_intensity():
+    data = np.random.random((50, 10, 10))
+    labels = np.zeros(data.shape[1:], dtype=int)
+    labels[2:5, 2:5] = 1
+    labels[6:9, 4:8] = 3  # label 2 has no pixels
+    expected = [np.average(np.where(labels == label, data, 0), axis=(-2, -1)) for label in range(1, 4)]
+
+    op = average_intensity()
+    times, intensities, _ = op(images=da.from_array(data, chunks=(20, 10, 10)), labels=labels)
+    assert np.array_equal(times, np.arange(len(data)))
+    assert np.allclose(intensities, expected)
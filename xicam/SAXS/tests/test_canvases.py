@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def test_error_bar_plot_canvas_per_frame_x():
+    from qtpy.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    import pyqtgraph as pg
+    from xicam.SAXS.canvases import ErrorBarIntentCanvas
+    from xicam.SAXS.intents import SAXSErrorBarIntent
+
+    # Two frames integrated with different geometries: one row of q per frame
+    q = np.array([[0.1, 0.2, 0.3], [0.2, 0.3, 0.4]])
+    I = np.array([[1., 2., 3.], [4., 5., 6.]])
+    intent = SAXSErrorBarIntent(name='q Integration', x=q, y=I, labels={'bottom': 'q', 'left': 'I'}, top=I / 10,
+                                bottom=I / 10)
+    canvas = ErrorBarIntentCanvas()
+    items = canvas.render(intent)
+
+    curves = [item for item in items if isinstance(item, pg.PlotDataItem)]
+    error_bars = [item for item in items if isinstance(item, pg.ErrorBarItem)]
+    assert len(curves) == len(error_bars) == 2
+    for curve, error_bar, row_q, row_I in zip(curves, error_bars, q, I):
+        assert np.array_equal(curve.xData, row_q)
+        assert np.array_equal(curve.yData, row_I)
+        assert np.array_equal(error_bar.opts['x'], row_q)
+        assert np.array_equal(error_bar.opts['top'], row_I / 10)
+    assert canvas.intent_to_items[intent] is items
+    assert canvas.unrender(intent)
+
+
+def test_error_bar_plot_canvas_lazy_rows():
+    from qtpy.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    from xicam.SAXS.canvases import ErrorBarIntentCanvas
+    from xicam.SAXS.intents import SAXSErrorBarIntent
+    from xicam.SAXS.utils import compute_lazy_frames, lazy_frame_map
+
+    calls = []
+
+    def integrate(frames):
+        calls.append(len(frames))
+        return frames.sum(axis=-1)
+
+    images = np.random.random((3, 4, 5))
+    I = lazy_frame_map(integrate, images, (4,), np.float64, chunk_size=2)
+    intent = SAXSErrorBarIntent(name='q Integration', x=np.arange(4.), y=I, labels={}, top=I / 10, bottom=I / 10)
+    canvas = ErrorBarIntentCanvas()
+    assert np.allclose(I[2].compute(), images[2].sum(axis=-1))
+    items = canvas.render(intent)
+
+    # Only the computed block is drawn, without computing the others on the GUI thread
+    assert calls == [1]
+    assert [len(item.yData) for item in items[:3]] == [0, 0, 4]
+    assert canvas._refresh_timer.isActive()
+
+    compute_lazy_frames([I])
+    canvas._refresh_pending()
+    for item, expected in zip(items, images.sum(axis=-1)):
+        assert np.allclose(item.yData, expected)
+    assert np.allclose(items[3].opts['top'], images[0].sum(axis=-1) / 10)
+    assert not canvas._refresh_timer.isActive()
+    assert canvas.unrender(intent)
@@ -2,6 +2,7 @@ import inspect
 import pytest
 
 import numpy as np
+from dask import array as da
 
 from xicam.core.execution.daskexecutor import DaskExecutor
 from xicam.core.execution.workflow import Workflow
@@ -158,6 +159,28 @@ class TestCorrectImage:
             old.corrected_images.value = np.where(np.isnan(old.corrected_images.value), 0, old.corrected_images.value)
             assert np.array_equal(old.corrected_images.value, op.corrected_images.value)
 
+    def test_lazy_dtype(self, op, old):
+        images = op.filled_values['images']
+        corrected_images, _ = op(images=images)
+        assert isinstance(corrected_images, da.Array)
+        assert corrected_images.dtype == np.int32
+        float_images, _ = op(images=images, dtype='float32')
+        assert float_images.dtype == np.float32
+        assert np.array_equal(np.asarray(float_images), np.asarray(corrected_images))
+
+    def test_fused(self, op, old):
+        images = op.filled_values['images']
+        corrected_images, _ = op(images=images)
+        fused_images, _ = op(images=images, fused=True)
+        assert fused_images.shape == corrected_images.shape
+        assert np.array_equal(np.asarray(fused_images), corrected_images)
+        assert np.array_equal(fused_images[1:3], corrected_images[1:3])
+        assert np.array_equal(fused_images[[0, 2]], corrected_images[[0, 2]])
+        assert np.array_equal(fused_images[np.array([1, 3])], corrected_images[[1, 3]])
+        assert np.array_equal(fused_images[:, 1], corrected_images[:, 1])
+        assert np.array_equal(fused_images[:, 1:, 0], corrected_images[:, 1:, 0])
+        assert np.array_equal(np.asarray(fused_images[:, 1:, :1]), corrected_images[:, 1:, :1])
+
     # def test_no_input_images(self, op, old):
     #     op.images.value = None
     #     with pytest.raises(TypeError):
@@ -192,3 +215,15 @@ class TestCorrectImage:
     #     op.darks.value = []
     #     with pytest.raises(TypeError):
     #         op.evaluate()
+
+
+def test_dark_model_gain_modes():
+    from xicam.SAXS.operations.darks import build_dark_model
+
+    # Pixel (0, 0) switches between gain modes; the other pixels stay in gain8 (0b00)
+    darks = np.full((6, 3, 2), 10, dtype=np.uint16)
+    darks[::2, 0, 0] = 0xC000 | 20
+    model = build_dark_model(da.from_array(darks, chunks=(4, 3, 2)))
+    assert model.counts[3, 0, 0] == 3 and model.counts[0, 0, 0] == 3
+    assert model.intensity[3, 0, 0] == 20 and model.intensity[0, 0, 0] == 10
+    assert np.all(model.dark_frame[1:] == 10)
@@ -0,0 +1,215 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+from dask import array as da
+from pyFAI.detectors import Detector
+from pyFAI.integrator.azimuthal import AzimuthalIntegrator
+
+from xicam.SAXS.operations.preprocess import preprocess_frames
+from xicam.SAXS.utils import compute_lazy_frames, computed_frames, integration, lazy_frame_map
+from xicam.SAXS.utils.enginecache import EngineCache
+from xicam.SAXS.utils.integration import integrate1d_frames, integrate1d_stack, integrate_chi_stack, integrate_lines, \
+    line_q, line_q_frames, line_weights
+
+
+SHAPE = (60, 80)
+
+
+@pytest.fixture
+def geometry():
+    detector = Detector(172e-6, 172e-6, max_shape=SHAPE)
+    return AzimuthalIntegrator(dist=0.1, poni1=2e-3, poni2=3e-3, detector=detector, wavelength=1e-10)
+
+
+@pytest.fixture
+def images():
+    return np.random.default_rng(0).poisson(100, (5, *SHAPE)).astype(np.float32)
+
+
+def test_batched_q_integration(geometry, images):
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[10:20, 30:40] = True
+    dark = np.full(SHAPE, 2, dtype=np.float32)
+    kwargs = dict(mask=mask, dark=dark, polarization_factor=0, radial_range=(0.1, 1.5))
+
+    q, I, sigma = integrate1d_stack(geometry, images, 50, 'q_A^-1', error_model='poisson', **kwargs)
+    expected = [geometry.integrate1d(frame, 50, unit='q_A^-1', method=('bbox', 'csr', 'cython'),
+                                     error_model='poisson', **kwargs)
+                for frame in images]
+    assert I.shape == sigma.shape == (len(images), 50)
+    assert np.allclose(q, expected[0].radial)
+    assert np.allclose(I, [result.intensity for result in expected], rtol=1e-4)
+    assert np.allclose(sigma, [result.sigma for result in expected], rtol=1e-4)
+
+    _, threaded_I = integrate1d_stack(geometry, images, 50, 'q_A^-1', workers=3, chunk_size=2, **kwargs)
+    assert np.array_equal(threaded_I, I)
+
+
+def test_lazy_q_integration(geometry, images):
+    q, I = integrate1d_stack(geometry, images, 50)
+    lazy_q, lazy_I = integrate1d_stack(geometry, images, 50, chunk_size=2, lazy=True)
+    assert isinstance(lazy_I, da.Array)
+    assert lazy_I.chunks[0] == (2, 2, 1)
+    assert np.allclose(lazy_q, q)
+    assert np.allclose(lazy_I[3].compute(), I[3])
+    assert np.allclose(lazy_I.compute(), I)
+
+
+def test_lazy_frame_map(images):
+    calls = []
+
+    def integrate(frames):
+        calls.append(len(frames))
+        return frames.sum(axis=-1)
+
+    lazy = lazy_frame_map(integrate, images, (SHAPE[0],), np.float32, chunk_size=2)
+    assert np.allclose(lazy[3].compute(), images[3].sum(axis=-1))
+    assert calls == [2]
+    # Filling in the rest skips the block computed already, and later computes reuse every block
+    compute_lazy_frames([lazy, images])
+    assert calls == [2, 2, 1]
+    assert np.allclose(lazy.compute(), images.sum(axis=-1))
+    assert calls == [2, 2, 1]
+
+
+def test_computed_frames(images):
+    calls = []
+
+    def integrate(frames):
+        calls.append(len(frames))
+        return frames.sum(axis=-1)
+
+    lazy = lazy_frame_map(integrate, images, (SHAPE[0],), np.float32, chunk_size=2)
+    lazy[3].compute()
+    # Blocks not computed yet read as NaN, and are left for compute_lazy_frames
+    (q, I), complete = computed_frames(np.arange(3), lazy)
+    assert calls == [2]
+    assert not complete
+    assert np.isnan(I[[0, 1, 4]]).all()
+    assert np.allclose(I[2:4], images[2:4].sum(axis=-1))
+    compute_lazy_frames([lazy])
+    (q, I), complete = computed_frames(np.arange(3), lazy)
+    assert complete
+    assert np.allclose(I, images.sum(axis=-1))
+
+
+def test_dynamic_geometry_integration(geometry, images):
+    moved = AzimuthalIntegrator(dist=0.1, poni1=4e-3, poni2=3e-3, detector=geometry.detector, wavelength=1e-10)
+    geometries = [geometry, moved, geometry, moved, moved]
+
+    q, I = integrate1d_frames(geometries, images, 50, chunk_size=2)
+    assert q.shape == I.shape == (len(images), 50)
+    for index, frame_geometry in enumerate(geometries):
+        expected_q, expected_I = integrate1d_stack(frame_geometry, images[index], 50)
+        assert np.allclose(q[index], expected_q)
+        assert np.allclose(I[index], expected_I[0])
+    assert not np.allclose(q[0], q[1])
+
+    with pytest.raises(ValueError):
+        integrate1d_frames(geometries[:2], images, 50)
+
+    line_qs = line_q_frames(geometries, SHAPE, axis=-1)
+    assert line_qs.shape == (len(images), SHAPE[1])
+    for row, frame_geometry in zip(line_qs, geometries):
+        assert np.array_equal(row, line_q(frame_geometry, SHAPE, axis=-1))
+
+
+def test_batched_chi_integration(geometry, images):
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[10:20, 30:40] = True
+    kwargs = dict(mask=mask, polarization_factor=0, radial_range=(0.1, 1.5), azimuth_range=(-90, 45), method='no')
+
+    chi, I = integrate_chi_stack(geometry, images, 36, 'q_A^-1', **kwargs)
+    expected = [geometry.integrate2d(frame, 1, 36, unit='q_A^-1', **kwargs) for frame in images]
+    assert I.shape == (len(images), 36)
+    assert np.allclose(chi, expected[0].azimuthal)
+    assert np.allclose(I, [result.intensity[:, 0] for result in expected], rtol=1e-4)
+
+
+def test_line_integration(images):
+    rng = np.random.default_rng(1)
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[10:20, 30:40] = True
+    dark = rng.random(SHAPE).astype(np.float32)
+    flat = 2 + rng.random(SHAPE).astype(np.float32)
+
+    weights = line_weights(SHAPE, mask, dark, flat, normalization_factor=2)
+    expected = np.sum((images - dark) * np.average(flat - dark) / (flat - dark) / 2 * ~mask, axis=-2)
+    assert np.allclose(integrate_lines(images, -2, weights, dark), expected, rtol=1e-5)
+    lazy = integrate_lines(da.from_array(images, chunks=(2, 30, 40)), -2, weights, dark)
+    assert isinstance(lazy, da.Array)
+    assert np.allclose(lazy.compute(), expected, rtol=1e-5)
+
+    I, sigma = integrate_lines(images, -2, weights, dark, error_model='poisson')
+    expected_sigma = np.sqrt(np.sum(np.maximum(images, 1) * weights ** 2, axis=-2))
+    assert np.allclose(I, expected, rtol=1e-5)
+    assert np.allclose(sigma, expected_sigma, rtol=1e-5)
+    _, lazy_sigma = integrate_lines(da.from_array(images, chunks=(2, 30, 40)), -2, weights, dark, error_model='poisson')
+    assert np.allclose(lazy_sigma.compute(), expected_sigma, rtol=1e-5)
+
+
+def test_engine_cache(geometry, images, tmp_path, monkeypatch):
+    monkeypatch.setattr(integration, 'engine_cache', EngineCache(str(tmp_path)))
+    monkeypatch.setattr(integration, '_integrator_cache', OrderedDict())
+
+    q, I = integrate1d_stack(geometry, images, 50)
+    assert len(list(tmp_path.iterdir())) == 1
+    integration._integrator_cache.clear()
+    cached_q, cached_I = integrate1d_stack(geometry, images, 50)
+    assert np.array_equal(q, cached_q)
+    assert np.array_equal(I, cached_I)
+
+    integration.engine_cache.max_size = 1
+    integration.engine_cache.evict()
+    assert not list(tmp_path.iterdir())
+
+
+def test_preprocessed_integration(geometry, images):
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[10:20, 30:40] = True
+    dark = np.full(SHAPE, 2, dtype=np.float32)
+    flat = np.full(SHAPE, 1.5, dtype=np.float32)
+    flat[0, :5] = 0
+
+    op = preprocess_frames()
+    kwargs = dict(azimuthal_integrator=geometry, mask=mask, dark=dark, flat=flat, normalization_factor=2)
+    data, combined_mask, variance = op(data=images, **kwargs)
+    assert data.dtype == np.float32
+    assert isinstance(variance, da.Array)
+    assert np.array_equal(combined_mask, mask | (flat == 0))
+    lazy_data, _, lazy_variance = op(data=da.from_array(images, chunks=(2, *SHAPE)), **kwargs)
+    assert np.allclose(lazy_data.compute(), data)
+    assert np.allclose(lazy_variance.compute(), variance)
+
+    kwargs = dict(polarization_factor=0, radial_range=(0.1, 1.5))
+    _, I, sigma = integrate1d_stack(geometry, data, 50, 'q_A^-1', mask=combined_mask, variance=variance, **kwargs)
+    expected = [geometry.integrate1d(frame, 50, unit='q_A^-1', method=('bbox', 'csr', 'cython'), mask=combined_mask,
+                                     dark=dark, flat=flat, normalization_factor=2, error_model='poisson', **kwargs)
+                for frame in images]
+    assert np.allclose(I, [result.intensity for result in expected], rtol=1e-4)
+    assert np.allclose(sigma, [result.sigma for result in expected], rtol=1e-4)
+
+    # x/z integrations of preprocessed frames are plain sums of the flat-divided frames: unlike the integrations of raw
+    # frames, they are not rescaled by the average flat response
+    weights = line_weights(SHAPE, combined_mask)
+    x_I, x_sigma = integrate_lines(data, -2, weights, variance=variance)
+    scale = np.where(combined_mask, np.inf, flat * 2)  # masked pixels are scaled to 0
+    assert np.allclose(x_I, np.sum((images - dark) / scale, axis=-2), rtol=1e-5)
+    assert np.allclose(x_sigma, np.sqrt(np.sum(np.maximum(images, 1) / scale ** 2, axis=-2)), rtol=1e-5)
+
+
+def test_reduce_workflow_corrects_once():
+    from xicam.SAXS.operations.workflows import ReduceWorkflow
+
+    workflow = ReduceWorkflow()
+    dark = np.ones(SHAPE)
+    workflow.fill_kwargs(dark=dark, normalization_factor=2, workers=4)
+    assert workflow.preprocess.filled_values['dark'] is dark
+    assert workflow.preprocess.filled_values['normalization_factor'] == 2
+    assert workflow.qintegrate.filled_values['lazy']
+    for operation in workflow.integrations:
+        assert operation.filled_values.get('dark') is None
+        assert operation.filled_values.get('normalization_factor', 1) == 1
+        assert operation.filled_values['workers'] == 4
+        assert not operation.visible['dark']
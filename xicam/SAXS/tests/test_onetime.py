@@ -1,3 +1,9 @@
+import numpy as np
+from dask import array as da
+
+from xicam.SAXS.operations.onetime import one_time_correlation, streaming_multi_tau_auto_corr
+
+
 def test_onetime(self):
     # catalog.upsert(start, stop, doc_gen, [], {})
     data = np.random.random((100, 10, 10))
@@ -7,4 +13,65 @@ def test_onetime(self):
     op = onetime.one_time_correlation()
     workflow = Workflow(operations=(op,))
     result = workflow.execute_synchronous(data=data, labels=labels)
-    print(result)
\ No newline at end of file
+    print(result)
+
+
+def test_onetime_streaming():
+    data = np.random.random((100, 10, 10))
+    labels = np.zeros(data.shape[1:])
+    labels[2:5, 2:5] = 1
+    labels[6:9, 4:8] = 2
+    op = one_time_correlation()
+    g2, tau, _, _ = op(images=data, labels=labels)
+    streamed_g2, streamed_tau, _, _ = op(images=da.from_array(data, chunks=(30, 10, 10)), labels=labels,
+                                         streaming=True)
+    assert np.allclose(g2, streamed_g2)
+    assert np.array_equal(tau, streamed_tau)
+
+
+def test_streaming_crop():
+    data = np.random.random((100, 10, 10))
+    labels = np.zeros((4, 5), dtype=int)
+    labels[1:3, 1:4] = 1
+    slices = (slice(3, 7), slice(2, 7))
+    g2, tau = streaming_multi_tau_auto_corr(data[(slice(None), *slices)], labels, 8, 16)
+    # The dask stack is cropped before its chunks are computed
+    streamed_g2, streamed_tau = streaming_multi_tau_auto_corr(da.from_array(data, chunks=(30, 10, 10)), labels, 8, 16,
+                                                              slices=slices)
+    assert np.allclose(g2, streamed_g2)
+    assert np.array_equal(tau, streamed_tau)
+
+
+def test_numba_onetime():
+    from skbeam.core.correlation import multi_tau_auto_corr
+    from xicam.SAXS.operations.multitau import numba_multi_tau_auto_corr
+
+    data = np.random.random((200, 10, 10))
+    labels = np.zeros(data.shape[1:], dtype=int)
+    labels[2:5, 2:5] = 1
+    labels[6:9, 4:8] = 2
+    g2, tau = multi_tau_auto_corr(4, 8, labels, data)
+    numba_g2, numba_tau = numba_multi_tau_auto_corr(4, 8, labels, data, chunk_size=30)
+    assert np.allclose(g2, numba_g2, rtol=1e-5)
+    assert np.array_equal(tau, numba_tau)
+
+    op = one_time_correlation()
+    op_g2, op_tau, _, _ = op(images=data, labels=labels)
+    numba_op_g2, numba_op_tau, _, _ = op(images=data, labels=labels, engine='numba')
+    assert np.allclose(op_g2, numba_op_g2, rtol=1e-5)
+    assert np.array_equal(op_tau, numba_op_tau)
+
+
+def test_fourier_correlation_empty_label():
+    from xicam.SAXS.operations.fourierautocorrelator import fourier_correlation
+
+    data = np.random.random((50, 10, 10))
+    labels = np.zeros(data.shape[1:], dtype=int)
+    labels[2:5, 2:5] = 1
+    labels[6:9, 4:8] = 3  # label 2 has no pixels
+    op = fourier_correlation()
+    g2 = op(data=data, labels=labels)
+    assert g2.shape == (3, len(data))
+    assert np.array_equal(g2[1], np.zeros(len(data)))
+    # Without a memory budget the pixels are gathered and transformed one at a time
+    assert np.allclose(op(data=data, labels=labels, max_memory=0), g2)
@@ -41,3 +41,43 @@ def test_Calibrant():
     calibrant = calibrant.CalibrantFactory()('AgBh')
     assert dumps(calibrant)
     assert loads(dumps(calibrant))
+
+
+def test_AzimuthalIntegrator_deepcopy():
+    import copy
+    import numpy as np
+    from xicam.SAXS.patches.pyFAI import AzimuthalIntegrator
+
+    det = pyFAI.detectors.detector_factory('pilatus2m')
+    ai = AzimuthalIntegrator(detector=det, wavelength=1e-10)
+    spectra = ai.integrate1d(np.ones(det.shape), 1000)
+    new_ai = copy.deepcopy(ai)
+    assert new_ai._cached_array.keys() == ai._cached_array.keys()
+    assert new_ai.engines.keys() == ai.engines.keys()
+    assert np.array_equal(new_ai.integrate1d(np.ones(det.shape), 1000).intensity, spectra.intensity)
+
+    # Changing the geometry of the copy only invalidates the copy's caches
+    new_ai.dist = 2
+    assert not new_ai._cached_array and not new_ai.engines
+    assert ai._cached_array and ai.engines
+    assert np.array_equal(ai.integrate1d(np.ones(det.shape), 1000).intensity, spectra.intensity)
+
+
+def test_AzimuthalIntegrator_compact_pickle():
+    import numpy as np
+    from xicam.SAXS.detectors import FastCCD
+    from xicam.SAXS.patches.pyFAI import AzimuthalIntegrator
+
+    det = FastCCD()
+    ai = AzimuthalIntegrator(detector=det, wavelength=1e-10)
+    spectra = ai.integrate1d(np.ones(det.max_shape), 1000)
+    # Neither the cached arrays nor the pixel corners are sent; the mask is bit-packed
+    assert len(dumps(ai)) < det.mask.size // 4
+    newai = loads(dumps(ai))
+    assert np.array_equal(newai.detector.mask, det.mask)
+    assert np.array_equal(newai.integrate1d(np.ones(det.max_shape), 1000).intensity, spectra.intensity)
+
+    ai.share_cached_arrays()
+    newai = loads(dumps(ai))
+    assert newai._cached_array.keys() == ai._cached_array.keys()
+    assert np.array_equal(newai.integrate1d(np.ones(det.max_shape), 1000).intensity, spectra.intensity)
@@ -18,3 +18,41 @@ def test_twotime(self):
     print(result)
 
     assert result == some_twotime_data
+
+
+def test_matmul_twotime():
+    from skbeam.core.correlation import two_time_corr
+    from xicam.SAXS.operations.twotime import matmul_two_time_corr
+
+    data = np.random.random((100, 10, 10)) + 1
+    labels = np.zeros(data.shape[1:], dtype=int)
+    labels[2:5, 2:5] = 1
+    labels[6:9, 4:8] = 2
+    expected = two_time_corr(labels, data, len(data), len(data), 1).g2
+    g2, _ = matmul_two_time_corr(labels, data, chunk_size=30)
+    assert np.allclose(g2, expected, rtol=1e-5)
+
+
+def test_triangular_twotime_storage():
+    from xicam.SAXS.operations.twotime import matmul_two_time_corr
+
+    data = np.random.random((50, 10, 10)) + 1
+    labels = np.ones(data.shape[1:], dtype=int)
+    dense, _ = matmul_two_time_corr(labels, data, chunk_size=16)
+    triangular, _ = matmul_two_time_corr(labels, data, chunk_size=16, storage='triangular')
+    assert triangular.nbytes < dense.nbytes
+    assert np.allclose(np.asarray(triangular), dense)
+    assert np.allclose(triangular[0, 10:20, 5:30], dense[0, 10:20, 5:30])
+
+
+def test_resampled_twotime_storage():
+    from xicam.SAXS.operations.twotime import matmul_two_time_corr
+
+    data = np.random.random((40, 10, 10)) + 1
+    labels = np.ones(data.shape[1:], dtype=int)
+    dense, _ = matmul_two_time_corr(labels, data, chunk_size=16)
+    resampled, lag = matmul_two_time_corr(labels, data, chunk_size=16, storage='resampled', resample_bins=8)
+    assert resampled.shape == (1, 8, len(lag))
+    # The first lag bins hold single lags; the zero lag bin averages the diagonal over each age bin
+    assert lag[0] == 0
+    assert np.isclose(resampled[0, 0, 0], np.mean(np.diag(dense[0])[:5]))
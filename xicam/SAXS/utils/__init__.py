@@ -1,64 +1,352 @@
-from typing import List
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Tuple
 
+import dask
 import numpy as np
+from dask import array as da
 import pyqtgraph as pg
 from camsaxs.remesh_bbox import q_from_geometry
 
 from xicam.SAXS.patches.pyFAI import AzimuthalIntegrator
 
 
+def frame_chunk_size(images, chunk_size: int = None) -> int:
+    """Number of frames to read at a time from an image stack.
+
+    When `chunk_size` is not provided, the stack's own (dask) chunking along the frame axis is used if available;
+    otherwise frames are read 64 at a time.
+    """
+    if chunk_size is None:
+        chunks = getattr(images, 'chunks', None)
+        chunk_size = chunks[0][0] if chunks else 64
+    return chunk_size
+
+
+def iter_frame_chunks(images, chunk_size: int = None) -> Iterator[np.ndarray]:
+    """Yield consecutive frame blocks of an image stack, resolved into memory one block at a time."""
+    chunk_size = frame_chunk_size(images, chunk_size)
+    for start in range(0, len(images), chunk_size):
+        yield _read_frames(images, start, start + chunk_size)
+
+
+def _read_frames(images, start: int, stop: int):
+    frames = images[start:stop]
+    return frames if isinstance(images, FrameStacks) else np.asarray(frames)
+
+
+class FrameStacks:
+    """Image stacks of the same length read in step, e.g. frames and their per-pixel variance.
+
+    Slicing returns a tuple with the block of each stack, so `iter_frame_chunks` and `map_frame_chunks` yield tuples of
+    matching blocks. Dask stacks are computed together, so inputs they share are only read once.
+    """
+    def __init__(self, *stacks):
+        self.stacks = stacks
+
+    def __len__(self):
+        return len(self.stacks[0])
+
+    @property
+    def chunks(self):
+        return getattr(self.stacks[0], 'chunks', None)
+
+    def __getitem__(self, item):
+        return tuple(np.asarray(block) for block in dask.compute(*(stack[item] for stack in self.stacks)))
+
+
+def map_frame_chunks(func: Callable, images, chunk_size: int = None, workers: int = 1) -> Iterator:
+    """Yield `func` applied to consecutive frame blocks of an image stack, in order.
+
+    With more than one worker, blocks are read and processed on a thread pool, which pays off for functions that
+    release the GIL (pyFAI's integrators, numpy and scipy kernels). At most two blocks per worker are in flight at any
+    time, so peak memory is bounded by the number of workers rather than the length of the stack. Unless `chunk_size`
+    is given, blocks are made small enough to keep every worker busy.
+    """
+    if workers <= 1:
+        for chunk in iter_frame_chunks(images, chunk_size):
+            yield func(chunk)
+        return
+
+    if chunk_size is None:
+        chunk_size = max(1, min(frame_chunk_size(images), -(-len(images) // workers)))
+
+    def process(start):
+        return func(_read_frames(images, start, start + chunk_size))
+
+    with ThreadPoolExecutor(workers) as executor:
+        in_flight = deque()
+        for start in range(0, len(images), chunk_size):
+            in_flight.append(executor.submit(process, start))
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+_LAZY_FRAMES_PREFIX = 'lazy-frames-'
+# Set (to a count of pending blocks) while `computed_frames` reads lazy results on the calling thread
+_computed_frames_reading = threading.local()
+
+
+def lazy_frame_map(func: Callable, images, frame_shape: Tuple[int, ...], dtype, chunk_size: int = None) -> da.Array:
+    """Lazily apply `func` to consecutive frame blocks of an image stack.
+
+    Returns a (frames, *frame_shape) dask array with one block per frame block. A block is only read and processed
+    when it is first computed; its result is then kept, so computing it again (e.g. after `compute_lazy_frames` filled
+    it in) never processes it twice. Read through `computed_frames`, blocks not computed yet are NaN instead.
+    """
+    chunk_size = frame_chunk_size(images, chunk_size)
+    starts = range(0, len(images), chunk_size)
+    computed = {}
+    lock = threading.Lock()
+
+    def compute_block(start):
+        with lock:
+            block = computed.get(start)
+        if block is None and getattr(_computed_frames_reading, 'pending', None) is not None:
+            _computed_frames_reading.pending += 1
+            return np.full((min(chunk_size, len(images) - start), *frame_shape), np.nan, dtype=dtype)
+        if block is None:
+            block = np.asarray(func(_read_frames(images, start, start + chunk_size)), dtype=dtype)
+            block.flags.writeable = False
+            with lock:
+                block = computed.setdefault(start, block)
+        return block
+
+    name = _LAZY_FRAMES_PREFIX + uuid.uuid4().hex
+    trailing = (0,) * len(frame_shape)
+    graph = {(name, i, *trailing): (compute_block, start) for i, start in enumerate(starts)}
+    chunks = (tuple(min(chunk_size, len(images) - start) for start in starts),) + tuple((n,) for n in frame_shape)
+    return da.Array(graph, name, chunks, dtype=dtype)
+
+
+def _has_lazy_frames(value) -> bool:
+    array = getattr(value, 'data', value)  # xarray results wrap their dask array
+    return isinstance(array, da.Array) and any(name.startswith(_LAZY_FRAMES_PREFIX) for name in array.dask.layers)
+
+
+def compute_lazy_frames(arrays: Iterable):
+    """Compute, one block at a time, every block of the `lazy_frame_map` results (or slices of them) among `arrays`.
+
+    Meant to fill in lazy results in a background thread once they are ingested, so that viewers only compute the
+    frames they show on demand; other values are ignored.
+    """
+    for array in arrays:
+        if _has_lazy_frames(array):
+            for block in getattr(array, 'data', array).blocks:
+                block.compute(scheduler='synchronous')
+
+
+def computed_frames(*values) -> Tuple[list, bool]:
+    """Read `values` as numpy arrays without computing any `lazy_frame_map` block that is not computed yet.
+
+    Frames of the pending blocks read as NaN. Also returns whether no block was pending, i.e. the values are complete.
+    Meant for plotting lazy results on the GUI thread while `compute_lazy_frames` fills them in.
+    """
+    if not any(_has_lazy_frames(value) for value in values):
+        return [None if value is None else np.asarray(value) for value in values], True
+    _computed_frames_reading.pending = 0
+    try:
+        values = dask.compute(*values, scheduler='synchronous')
+        pending = _computed_frames_reading.pending
+    finally:
+        _computed_frames_reading.pending = None
+    return [None if value is None else np.asarray(value) for value in values], not pending
+
+
+def label_pixel_index(labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """CSR-style index of the pixels belonging to each label.
+
+    Returns `pixel_list`, the raveled indices of all labeled pixels ordered by label, and `offsets`, such that the
+    pixels of label `i` are `pixel_list[offsets[i - 1]:offsets[i]]`. The index of a label array returned by
+    `get_label_array` is computed once and cached along with it.
+    """
+    with _cache_lock:
+        cached = _pixel_index_cache.get(id(labels))
+    if cached is not None and cached[0] is labels:
+        return cached[1]
+
+    flat_labels = np.ravel(labels).astype(np.int_)
+    pixel_list = np.flatnonzero(flat_labels)
+    pixel_list = pixel_list[np.argsort(flat_labels[pixel_list], kind='stable')]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(flat_labels[pixel_list])[1:])]).astype(np.int_)
+
+    with _cache_lock:
+        if any(labels is entry for entry in _label_array_cache.values()):
+            pixel_list.flags.writeable = offsets.flags.writeable = False
+            _pixel_index_cache[id(labels)] = labels, (pixel_list, offsets)
+    return pixel_list, offsets
+
+
+def geometry_key(geometry: AzimuthalIntegrator) -> tuple:
+    """Hashable summary of the parameters of a geometry that determine its q/chi maps."""
+    if geometry is None:
+        return None
+    detector = getattr(geometry, 'detector', None)
+    return (tuple(getattr(geometry, name, None)
+                  for name in ('dist', 'poni1', 'poni2', 'rot1', 'rot2', 'rot3', 'wavelength'))
+            + (type(detector).__name__,)
+            + tuple(getattr(detector, name, None) for name in ('pixel1', 'pixel2', 'max_shape')))
+
+
+# Label arrays are rasterized once per ROI state and merged once per combination of ROIs; the caches are bounded LRUs
+_ROI_LABEL_CACHE_SIZE = 32
+_LABEL_ARRAY_CACHE_SIZE = 8
+_cache_lock = threading.Lock()
+_roi_label_cache = OrderedDict()
+_label_array_cache = OrderedDict()
+_pixel_index_cache = {}
+
+
+def _roi_key(roi: pg.ROI, image_item: pg.ImageItem, shape: tuple, geometry: AzimuthalIntegrator) -> tuple:
+    # Everything a rasterized ROI depends on: its saved state, its handles, its scalar parameters (radii, widths,
+    # segment counts...), the image item's transform and, for q-based ROIs, the geometry
+    state = repr(sorted(roi.saveState().items())) if hasattr(roi, 'saveState') else None
+    handles = tuple(tuple(handle.pos()) for handle in roi.getHandles()) if hasattr(roi, 'getHandles') else ()
+    parameters = tuple(sorted((name, value) for name, value in vars(roi).items()
+                              if isinstance(value, (bool, int, float, str))))
+    transform = None
+    if image_item is not None:
+        t = image_item.transform()
+        transform = (t.m11(), t.m12(), t.m13(), t.m21(), t.m22(), t.m23(), t.m31(), t.m32(), t.m33(),
+                     tuple(image_item.pos()))
+    geometry = geometry_key(geometry) if getattr(roi, 'is_Q_based', False) else None
+    return id(roi), type(roi).__name__, state, handles, parameters, transform, shape, geometry
+
+
+def _cache_put(cache: OrderedDict, key, value, size: int):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > size:
+        _, evicted = cache.popitem(last=False)
+        _pixel_index_cache.pop(id(evicted), None)
+
+
+def _roi_label_array(roi: pg.ROI, key: tuple, shape: tuple, image_item: pg.ImageItem,
+                     geometry: AzimuthalIntegrator) -> np.ndarray:
+    with _cache_lock:
+        label = _roi_label_cache.get(key)
+        if label is not None:
+            _roi_label_cache.move_to_end(key)
+            return label
+
+    # Rasterize against a blank frame so the labels only depend on the ROI (not on zero-valued pixels of the data)
+    template = np.ones(shape, dtype=np.uint8)
+    if getattr(roi, 'is_Q_based', False):
+        if not geometry:
+            raise ValueError('No geometry provided.')
+        label = roi.getLabelArray(template, image_item, geometry=geometry)
+    else:
+        label = roi.getLabelArray(template, image_item)
+    label = np.asarray(label).astype(np.uint16)
+    label.flags.writeable = False
+
+    with _cache_lock:
+        _cache_put(_roi_label_cache, key, label, _ROI_LABEL_CACHE_SIZE)
+    return label
+
+
 def get_label_array(images: np.ndarray, rois: np.ndarray = None, image_item: pg.ImageItem = None, geometry: AzimuthalIntegrator = None) -> np.ndarray:
-    while images.ndim > 2:
-        images = images[0]
+    """Merge the label arrays of `rois` into a single (read-only) label array with the shape of one frame.
+
+    The labels of each ROI are offset by the largest label of the ROIs before it; where ROIs overlap, the later ROI
+    wins. Each ROI is only re-rasterized when its state, the image item's transform, the frame shape or (for q-based
+    ROIs) the geometry change, and merged label arrays are cached per combination of ROIs.
+    """
+    shape = tuple(images.shape[-2:])
 
     if rois is None:
-        return np.ones_like(images)
+        return np.ones(shape, dtype=np.uint16)
+
+    keys = tuple(_roi_key(roi, image_item, shape, geometry) for roi in rois)
+    with _cache_lock:
+        label_array = _label_array_cache.get(keys)
+        if label_array is not None:
+            _label_array_cache.move_to_end(keys)
+            return label_array
+
+    roi_labels = [_roi_label_array(roi, key, shape, image_item, geometry) for roi, key in zip(rois, keys)]
+    roi_maxes = [int(label.max()) if label.size else 0 for label in roi_labels]
+    dtype = np.uint16 if sum(roi_maxes) <= np.iinfo(np.uint16).max else np.uint32
+
     # Create zeros label array to insert new labels into (if multiple ROIs)
-    label_array = np.zeros(images.shape)
-    roi_masks = []
-    for roi in rois:
-        # TODO: Should label array be astype(np.int) (instead of float)?
-        if getattr(roi, 'is_Q_based', False):
-            if not geometry:
-                raise ValueError('No geometry provided.')
-            label = roi.getLabelArray(images, image_item, geometry=geometry)
-        else:
-            label = roi.getLabelArray(images, image_item)
-
-        # Store the boolean mask of each label array
-        roi_mask = label.astype(np.bool)
-        roi_masks.append(roi_mask)
-        # Grab the current label array maximum value (so we can increment multiple labels accordingly)
-        label_array_max = label_array.max()
-        label = np.where(label > 0, label + label_array_max, label)
-        # For single roi, our max will be 0 (since label_array is just np.zeros so far, hasn't been modified)
-        if label_array_max == 0:
-            label_array = label
-        else:
-            # FIXME right now, if labels overlap, label integers are being added together (into a new label value)
-            # Adjust any currently non-masked areas with the new label
-            label_array = np.where(label_array == 0, label, label_array)
-            #
-            label_array = np.where(label_array > 0,
-                                   np.where(label > 0, label, label_array),
-                                   label_array)
-            # label_array = np.where(label_array > 0,
-            #                        label or label_array,
-            #                        label_array)
-
-    return label_array.astype(np.int)
+    label_array = np.zeros(shape, dtype=dtype)
+    offset = 0
+    for label, label_max in zip(roi_labels, roi_maxes):
+        if not label_max:
+            continue
+        # FIXME right now, if labels overlap, the later ROI overwrites the earlier ones
+        mask = label > 0
+        label_array[mask] = label[mask].astype(dtype) + offset
+        offset += label_max
+    label_array.flags.writeable = False
+
+    with _cache_lock:
+        _cache_put(_label_array_cache, keys, label_array, _LABEL_ARRAY_CACHE_SIZE)
+    return label_array
+
+
+class QMap(NamedTuple):
+    """Per-pixel scattering vector components (horizontal, vertical) and magnitude, in inverse Angstroms."""
+    q_h: np.ndarray
+    q_v: np.ndarray
+    q: np.ndarray
+
+
+_Q_MAP_CACHE_SIZE = 4
+_q_map_cache = OrderedDict()
+
+
+def q_map(shape: Tuple[int, int],
+          geometry: AzimuthalIntegrator,
+          scattering_mode: str = 'transmission',
+          incidence_angle: float = None) -> QMap:
+    """Read-only float32 q maps for a detector of the given shape.
+
+    The maps are computed once per combination of geometry parameters (see `geometry_key`), shape, scattering mode and
+    incidence angle, and shared by all callers in the process.
+    """
+    reflection = scattering_mode == 'reflection'
+    incidence_angle = incidence_angle or 0.0
+    key = tuple(shape), geometry_key(geometry), reflection, incidence_angle
+    with _cache_lock:
+        cached = _q_map_cache.get(key)
+        if cached is not None:
+            _q_map_cache.move_to_end(key)
+            return cached
+
+    # Bypass q_from_geometry's own single-entry lru_cache, which keys on (and keeps alive) the geometry object itself
+    compute_q = getattr(q_from_geometry, '__wrapped__', q_from_geometry)
+    q = compute_q(tuple(shape), geometry, reflection, incidence_angle)
+    q_h = q[..., 0].astype(np.float32)
+    q_v = q[..., 1].astype(np.float32)
+    q_norm = np.hypot(q_h, q_v)
+    for array in (q_h, q_v, q_norm):
+        array.flags.writeable = False
+    cached = QMap(q_h, q_v, q_norm)
+
+    with _cache_lock:
+        _cache_put(_q_map_cache, key, cached, _Q_MAP_CACHE_SIZE)
+    return cached
 
 
 def average_q_from_labels(labels: np.ndarray,
                           geometry: AzimuthalIntegrator,
                           scattering_mode: str,
                           incidence_angle=None) -> List[float]:
-    # q_h, q_v
-    q = q_from_geometry(labels.shape, geometry, scattering_mode == 'reflection', incidence_angle or 0.0)
-
     # TODO: how can we allow choosing between these different q values (q_h, q_v, q_norm)
     # q magnitude
-    q = np.linalg.norm(q, axis=2)
-    average_qs = [np.average(q, weights=(labels == i)) for i in range(1, labels.max() + 1)]
+    q = q_map(labels.shape, geometry, scattering_mode, incidence_angle).q
+
+    # Sum q and count pixels per label in one pass each
+    labels = np.ravel(labels).astype(np.int_)
+    num_labels = labels.max()
+    q_sums = np.bincount(labels, weights=q.ravel(), minlength=num_labels + 1)[1:]
+    counts = np.bincount(labels, minlength=num_labels + 1)[1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average_qs = q_sums / counts
     # TODO: return a dict mapping labels to qs?
-    return average_qs
+    return average_qs.tolist()
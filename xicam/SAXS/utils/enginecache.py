@@ -0,0 +1,80 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+import pyFAI
+
+# Bump when the layout or meaning of the stored arrays changes so that stale entries are ignored
+_FORMAT_VERSION = 1
+
+
+class EngineCache:
+    """On-disk store of integration engines (sparse matrices and bin centers) shared between sessions.
+
+    Each entry is a directory named by a fingerprint of its key, holding one uncompressed .npy file per array so that
+    entries are memory-mapped rather than read on load. Entries are evicted least-recently-used (by modification time,
+    which is refreshed on every load) once the cache grows beyond `max_size` bytes.
+    """
+    def __init__(self, path: str, max_size: int = 2 * 2 ** 30):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(key) -> str:
+        """Hash of a key made of plain values (tuples, strings, numbers); includes the pyFAI and format versions."""
+        return hashlib.sha1(repr((_FORMAT_VERSION, pyFAI.version, key)).encode()).hexdigest()
+
+    def load(self, key) -> Optional[Dict[str, np.ndarray]]:
+        """Memory-mapped (read-only) arrays stored for `key`, or None if there is no (readable) entry."""
+        entry = os.path.join(self.path, self.fingerprint(key))
+        try:
+            arrays = {name[:-len('.npy')]: np.load(os.path.join(entry, name), mmap_mode='r')
+                      for name in os.listdir(entry) if name.endswith('.npy')}
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return arrays or None
+
+    def store(self, key, arrays: Dict[str, np.ndarray]):
+        """Write the arrays for `key`, then evict old entries; failures (e.g. a read-only or full disk) are ignored."""
+        if self.max_size <= 0:
+            return
+        entry = os.path.join(self.path, self.fingerprint(key))
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # Write to a temporary directory first so that concurrent sessions never see partial entries
+            staging = tempfile.mkdtemp(dir=self.path, prefix='.staging-')
+            for name, array in arrays.items():
+                np.save(os.path.join(staging, f'{name}.npy'), np.asarray(array))
+            try:
+                os.rename(staging, entry)
+            except OSError:  # another session stored the same entry meanwhile
+                shutil.rmtree(staging, ignore_errors=True)
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in `max_size`."""
+        with self._lock:
+            try:
+                entries = [os.path.join(self.path, name) for name in os.listdir(self.path)
+                           if not name.startswith('.')]
+                sizes = {entry: sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                         for entry in entries}
+                total = sum(sizes.values())
+                for entry in sorted(entries, key=os.path.getmtime):
+                    if total <= self.max_size:
+                        break
+                    shutil.rmtree(entry, ignore_errors=True)
+                    total -= sizes[entry]
+            except OSError:
+                pass
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,562 @@
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Callable, List, Sequence, Tuple, Union
+
+import numpy as np
+from dask import array as da
+from pyFAI import units
+from scipy import sparse
+
+from xicam.core.paths import user_cache_dir
+
+from . import FrameStacks, geometry_key, lazy_frame_map, map_frame_chunks
+from .enginecache import EngineCache
+
+
+class SparseIntegrator:
+    """Azimuthal integration expressed as a sparse (bins x pixels) matrix.
+
+    The matrix holds pyFAI's CSR pixel-splitting coefficients, so integrating a whole (frames x pixels) block is a
+    single sparse mat-mat product. Dark, flat, solid angle and polarization corrections are folded into per-bin
+    vectors that are computed once per stack.
+    """
+    def __init__(self, matrix: sparse.csr_matrix, bin_centers: np.ndarray, empty: float = 0.):
+        self.matrix = matrix
+        self.bin_centers = bin_centers
+        self.empty = empty
+        self._squared_matrix = None
+
+    @property
+    def npt(self) -> int:
+        return self.matrix.shape[0]
+
+    @property
+    def squared_matrix(self) -> sparse.csr_matrix:
+        """The matrix of squared coefficients, which propagates per-pixel variances into per-bin variances."""
+        if self._squared_matrix is None:
+            self._squared_matrix = self.matrix.power(2)
+        return self._squared_matrix
+
+    def integrate(self,
+                  frames,
+                  dark: np.ndarray = None,
+                  normalization: np.ndarray = None,
+                  normalization_factor: float = 1,
+                  chunk_size: int = None,
+                  workers: int = 1,
+                  lazy: bool = False,
+                  variance: np.ndarray = None,
+                  error_model: str = None):
+        """Integrate a stack of frames into a (frames x npt) array.
+
+        As in pyFAI, each bin is the sum of the dark-subtracted signal over the sum of the per-pixel `normalization`
+        (flat x solid angle x polarization) of the pixels contributing to it; empty bins are set to `empty`. Chunks of
+        frames are integrated concurrently by `workers` threads, or, if `lazy`, returned as a dask array whose chunks
+        are integrated when first computed (see `lazy_frame_map`).
+
+        With `error_model="poisson"` or a `variance` (per pixel, of one frame or of every frame), the standard error
+        of each bin is returned along with the intensities. The Poisson variance of a pixel is max(1, counts), as in
+        pyFAI; variances are binned by the squared coefficients, one more sparse product per chunk.
+        """
+        if error_model not in (None, 'poisson'):
+            raise ValueError(f'Unknown error model "{error_model}"; expected "poisson".')
+        with_sigma = error_model is not None or variance is not None
+
+        offset = 0 if dark is None else self.matrix @ np.ravel(dark).astype(np.float32)
+        denominator = self.matrix @ (np.ones(self.matrix.shape[1], dtype=np.float32) if normalization is None
+                                     else np.ravel(normalization).astype(np.float32))
+        denominator = denominator * normalization_factor
+        empty = denominator == 0
+
+        stacked_variance = variance is not None and np.ndim(variance) == 3
+        if stacked_variance:
+            frames = FrameStacks(frames, variance)
+        elif variance is not None:
+            # The same variance for every frame; it is binned once
+            binned_variance = self.squared_matrix @ np.ravel(variance).astype(np.float32)
+
+        def integrate_chunk(chunk):
+            if stacked_variance:
+                chunk, variance_chunk = chunk
+            chunk = chunk.reshape(len(chunk), -1).astype(np.float32)
+            signal = (self.matrix @ chunk.T).T - offset
+            with np.errstate(divide='ignore', invalid='ignore'):
+                intensity = np.where(empty, self.empty, signal / denominator)
+                if not with_sigma:
+                    return intensity
+                if stacked_variance:
+                    binned = (self.squared_matrix @ variance_chunk.reshape(len(chunk), -1).astype(np.float32).T).T
+                elif variance is not None:
+                    binned = binned_variance
+                else:
+                    binned = (self.squared_matrix @ np.maximum(chunk, 1).T).T
+                sigma = np.where(empty, self.empty, np.sqrt(binned) / denominator)
+            return np.stack(np.broadcast_arrays(intensity, sigma), axis=1)
+
+        frame_shape = (2, self.npt) if with_sigma else (self.npt,)
+        if lazy:
+            results = lazy_frame_map(integrate_chunk, frames, frame_shape, np.float32, chunk_size)
+        else:
+            results = list(map_frame_chunks(integrate_chunk, frames, chunk_size, workers))
+            results = np.concatenate(results) if results else np.empty((0, *frame_shape), dtype=np.float32)
+        return (results[:, 0], results[:, 1]) if with_sigma else results
+
+
+def _split(method) -> str:
+    # Map an integrate1d method name onto a pyFAI pixel splitting scheme
+    method = str(method).lower()
+    if 'full' in method or 'splitpixel' in method:
+        return 'full'
+    if 'no' in method:
+        return 'no'
+    return 'bbox'
+
+
+def _mask_checksum(mask: np.ndarray):
+    return None if mask is None else (mask.shape, zlib.crc32(np.packbits(np.asarray(mask, dtype=bool))))
+
+
+_INTEGRATOR_CACHE_SIZE = 8
+_integrator_cache = OrderedDict()
+_integrator_lock = threading.Lock()
+
+# Integration matrices persist across sessions here; set max_size to 0 to disable
+engine_cache = EngineCache(os.path.join(user_cache_dir, 'SAXS', 'engines'))
+
+
+def sparse_integrator(azimuthal_integrator,
+                      shape: Tuple[int, int],
+                      npt: int,
+                      unit: Union[str, units.Unit] = 'q_A^-1',
+                      radial_range: Tuple[float, float] = None,
+                      azimuth_range: Tuple[float, float] = None,
+                      mask: np.ndarray = None,
+                      method: str = 'splitbbox') -> SparseIntegrator:
+    """Sparse integrator for a geometry, cached per geometry, shape, npt, unit, ranges, mask and splitting scheme.
+
+    Integrators are kept in memory and persisted to `engine_cache`, so later sessions load them instead of rebuilding.
+    """
+    unit = units.to_unit(unit)
+    if mask is None:
+        mask = azimuthal_integrator.detector.mask
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+    split = _split(method)
+    radial_range = tuple(map(float, radial_range)) if radial_range is not None else None
+    azimuth_range = tuple(map(float, azimuth_range)) if azimuth_range is not None else None
+    key = (geometry_key(azimuthal_integrator), tuple(shape), npt, unit.name, radial_range, azimuth_range, split,
+           _mask_checksum(mask), azimuthal_integrator.empty)
+
+    def build():
+        engine = azimuthal_integrator.setup_sparse_integrator(
+            tuple(shape), npt, mask=mask, pos0_range=radial_range,
+            pos1_range=tuple(np.deg2rad(azimuth_range)) if azimuth_range is not None else None,
+            unit=unit, split=split, algo='CSR')
+        matrix = sparse.csr_matrix(engine.lut, shape=(npt, int(np.prod(shape))))
+        return SparseIntegrator(matrix, np.asarray(engine.bin_centers) * unit.scale, azimuthal_integrator.empty)
+
+    return _cached_integrator(key, build)
+
+
+def chi_integrator(azimuthal_integrator,
+                   shape: Tuple[int, int],
+                   npt_azim: int,
+                   unit: Union[str, units.Unit] = 'q_A^-1',
+                   radial_range: Tuple[float, float] = None,
+                   azimuth_range: Tuple[float, float] = None,
+                   mask: np.ndarray = None,
+                   method: str = 'splitbbox') -> SparseIntegrator:
+    """Sparse integrator of chi profiles over a radial range, cached like `sparse_integrator`.
+
+    Pixels enter the profile if they fall within `radial_range` (in `unit`) and are binned along chi (in degrees),
+    splitting each pixel's chi extent over the bins it covers unless `method` asks for no splitting. This gives the
+    same profile as `integrate2d` with a single radial bin without building a 2D engine.
+    """
+    unit = units.to_unit(unit)
+    if mask is None:
+        mask = azimuthal_integrator.detector.mask
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+    split = _split(method)
+    radial_range = tuple(map(float, radial_range)) if radial_range is not None else None
+    azimuth_range = tuple(map(float, azimuth_range)) if azimuth_range is not None else None
+    key = ('chi', geometry_key(azimuthal_integrator), tuple(shape), npt_azim, unit.name, radial_range, azimuth_range,
+           split, _mask_checksum(mask), azimuthal_integrator.empty)
+    return _cached_integrator(key, lambda: _build_chi_integrator(azimuthal_integrator, tuple(shape), npt_azim, unit,
+                                                                 radial_range, azimuth_range, mask, split))
+
+
+def _build_chi_integrator(azimuthal_integrator, shape, npt, unit, radial_range, azimuth_range, mask, split):
+    chi = azimuthal_integrator.array_from_unit(shape, 'center', units.CHI_DEG).ravel()
+    radial = azimuthal_integrator.array_from_unit(shape, 'center', unit).ravel()
+    if split == 'no':
+        chi_low = chi_high = chi
+        radial_low = radial_high = radial
+    else:
+        delta_chi = azimuthal_integrator.array_from_unit(shape, 'delta', units.CHI_DEG).ravel()
+        delta_radial = azimuthal_integrator.array_from_unit(shape, 'delta', unit).ravel()
+        chi_low, chi_high = np.maximum(chi - delta_chi, -180), np.minimum(chi + delta_chi, 180)
+        radial_low, radial_high = radial - delta_radial, radial + delta_radial
+
+    valid = np.ones(chi.shape, dtype=bool) if mask is None else ~mask.ravel()
+    if azimuth_range is None:
+        azimuth_range = (chi_low[valid].min(), chi_high[valid].max()) if valid.any() else (-180, 180)
+    chi_min, chi_max = azimuth_range
+    valid &= (chi_high >= chi_min) & (chi_low <= chi_max)
+    # With a single radial bin, every pixel touching the radial range contributes in full
+    if radial_range is not None:
+        valid &= (radial_high >= radial_range[0]) & (radial_low <= radial_range[1])
+    pixels = np.flatnonzero(valid)
+
+    # Positions in units of bins, clipped to the azimuthal range
+    bin_width = (chi_max - chi_min) / npt
+    low = (np.clip(chi_low[pixels], chi_min, chi_max) - chi_min) / bin_width
+    high = (np.clip(chi_high[pixels], chi_min, chi_max) - chi_min) / bin_width
+    first = np.minimum(np.floor(low).astype(np.int64), npt - 1)
+    last = np.minimum(np.floor(high).astype(np.int64), npt - 1)
+    span = high - low
+
+    rows, columns, weights = [], [], []
+    for offset in range(int((last - first).max(initial=0)) + 1):
+        in_range = first + offset <= last
+        bins = first[in_range] + offset
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Pixels narrower than numerical precision fall entirely in their first bin
+            overlap = np.minimum(high[in_range], bins + 1) - np.maximum(low[in_range], bins)
+            weight = np.where(span[in_range] > 0, overlap / span[in_range], 1)
+        rows.append(bins)
+        columns.append(pixels[in_range])
+        weights.append(weight)
+
+    matrix = sparse.csr_matrix((np.concatenate(weights).astype(np.float32),
+                                (np.concatenate(rows), np.concatenate(columns))),
+                               shape=(npt, int(np.prod(shape))))
+    matrix.eliminate_zeros()
+    bin_centers = chi_min + (np.arange(npt) + 0.5) * bin_width
+    return SparseIntegrator(matrix, bin_centers, azimuthal_integrator.empty)
+
+
+def _cached_integrator(key, build) -> SparseIntegrator:
+    # Memory first, then the on-disk engine cache, then build (and persist) the integrator
+    def load_or_build():
+        arrays = engine_cache.load(key)
+        if arrays is not None:
+            rows, columns, empty = arrays['meta']
+            matrix = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                       shape=(int(rows), int(columns)), copy=False)
+            return SparseIntegrator(matrix, arrays['bin_centers'], float(empty))
+
+        integrator = build()
+        matrix = integrator.matrix
+        engine_cache.store(key, dict(data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                                     bin_centers=integrator.bin_centers,
+                                     meta=np.array([*matrix.shape, integrator.empty], dtype=np.float64)))
+        return integrator
+
+    return _cached(_integrator_cache, key, load_or_build, _INTEGRATOR_CACHE_SIZE)
+
+
+def _cached(cache: OrderedDict, key, build, size: int):
+    with _integrator_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+            return value
+
+    value = build()
+    with _integrator_lock:
+        cache[key] = value
+        while len(cache) > size:
+            cache.popitem(last=False)
+    return value
+
+
+def normalization_array(azimuthal_integrator,
+                        shape: Tuple[int, int],
+                        flat: np.ndarray = None,
+                        polarization_factor: float = None) -> np.ndarray:
+    """Per-pixel normalization (flat x solid angle x polarization), as applied by pyFAI's integrators."""
+    normalization = np.array(azimuthal_integrator.solidAngleArray(shape), dtype=np.float32)
+    if flat is not None:
+        normalization *= np.asarray(flat, dtype=np.float32)
+    if polarization_factor is not None:
+        normalization *= np.asarray(azimuthal_integrator.polarization(shape, polarization_factor), dtype=np.float32)
+    return normalization
+
+
+def integrate1d_stack(azimuthal_integrator,
+                      data,
+                      npt: int,
+                      unit: Union[str, units.Unit] = 'q_A^-1',
+                      radial_range: Tuple[float, float] = None,
+                      azimuth_range: Tuple[float, float] = None,
+                      mask: np.ndarray = None,
+                      dark: np.ndarray = None,
+                      flat: np.ndarray = None,
+                      polarization_factor: float = None,
+                      method: str = 'splitbbox',
+                      normalization_factor: float = 1,
+                      chunk_size: int = None,
+                      workers: int = 1,
+                      lazy: bool = False,
+                      variance: np.ndarray = None,
+                      error_model: str = None) -> Tuple[np.ndarray, ...]:
+    """Radially integrate every frame of a stack; returns the bin centers and a (frames x npt) intensity array.
+
+    With `lazy`, the intensities are a dask array integrated chunk by chunk on demand. With an `error_model` or a
+    `variance`, a (frames x npt) array of standard errors is returned as well (see `SparseIntegrator.integrate`).
+    """
+    if data.ndim == 2:
+        data = data[None]
+    shape = tuple(data.shape[-2:])
+    integrator = sparse_integrator(azimuthal_integrator, shape, npt, unit, radial_range, azimuth_range, mask, method)
+    normalization = normalization_array(azimuthal_integrator, shape, flat, polarization_factor)
+    return _with_bin_centers(integrator, integrator.integrate(data, dark, normalization, normalization_factor,
+                                                              chunk_size, workers, lazy, variance, error_model))
+
+
+def integrate_chi_stack(azimuthal_integrator,
+                        data,
+                        npt_azim: int,
+                        unit: Union[str, units.Unit] = 'q_A^-1',
+                        radial_range: Tuple[float, float] = None,
+                        azimuth_range: Tuple[float, float] = None,
+                        mask: np.ndarray = None,
+                        dark: np.ndarray = None,
+                        flat: np.ndarray = None,
+                        polarization_factor: float = None,
+                        method: str = 'splitbbox',
+                        normalization_factor: float = 1,
+                        chunk_size: int = None,
+                        workers: int = 1,
+                        lazy: bool = False,
+                        variance: np.ndarray = None,
+                        error_model: str = None) -> Tuple[np.ndarray, ...]:
+    """Azimuthally profile every frame of a stack; returns the chi bin centers and a (frames x npt_azim) array.
+
+    Laziness and standard errors are as in `integrate1d_stack`.
+    """
+    if data.ndim == 2:
+        data = data[None]
+    shape = tuple(data.shape[-2:])
+    integrator = chi_integrator(azimuthal_integrator, shape, npt_azim, unit, radial_range, azimuth_range, mask, method)
+    normalization = normalization_array(azimuthal_integrator, shape, flat, polarization_factor)
+    return _with_bin_centers(integrator, integrator.integrate(data, dark, normalization, normalization_factor,
+                                                              chunk_size, workers, lazy, variance, error_model))
+
+
+def _with_bin_centers(integrator: SparseIntegrator, results) -> tuple:
+    return (integrator.bin_centers, *results) if isinstance(results, tuple) else (integrator.bin_centers, results)
+
+
+def group_frames_by_geometry(geometries: Sequence) -> List[Tuple[object, np.ndarray]]:
+    """Group the frames of a stack by identical geometry (see `geometry_key`).
+
+    Returns a (geometry, frame indices) pair per distinct geometry, in order of first appearance.
+    """
+    groups = OrderedDict()
+    for index, geometry in enumerate(geometries):
+        groups.setdefault(geometry_key(geometry), (geometry, []))[1].append(index)
+    return [(geometry, np.asarray(indices)) for geometry, indices in groups.values()]
+
+
+class _FrameSelection:
+    # The frames `indices` of a stack, read one slice of indices at a time (as `map_frame_chunks` reads a stack)
+    def __init__(self, images, indices: np.ndarray):
+        self.images = images
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def ndim(self) -> int:
+        return self.images.ndim
+
+    def __getitem__(self, item):
+        return self.images[self.indices[item]]
+
+
+def _integrate_by_geometry(integrator_for: Callable, geometries: Sequence, data, npt: int, dark, flat,
+                           polarization_factor, normalization_factor, chunk_size, workers, variance, error_model):
+    if data.ndim == 2:
+        data = data[None]
+    if len(geometries) != len(data):
+        raise ValueError(f'Expected one geometry per frame; got {len(geometries)} geometries for {len(data)} frames.')
+    shape = tuple(data.shape[-2:])
+    with_sigma = error_model is not None or variance is not None
+    bin_centers = np.empty((len(data), npt))
+    results = [np.empty((len(data), npt), dtype=np.float32) for _ in range(2 if with_sigma else 1)]
+    for geometry, indices in group_frames_by_geometry(geometries):
+        integrator = integrator_for(geometry, shape)
+        normalization = normalization_array(geometry, shape, flat, polarization_factor)
+        bin_centers[indices] = integrator.bin_centers
+        group_variance = _FrameSelection(variance, indices) if np.ndim(variance) == 3 else variance
+        group_results = integrator.integrate(_FrameSelection(data, indices), dark, normalization, normalization_factor,
+                                             chunk_size, workers, variance=group_variance, error_model=error_model)
+        for result, group_result in zip(results, group_results if with_sigma else [group_results]):
+            result[indices] = group_result
+    return (bin_centers, *results)
+
+
+def integrate1d_frames(geometries: Sequence,
+                       data,
+                       npt: int,
+                       unit: Union[str, units.Unit] = 'q_A^-1',
+                       radial_range: Tuple[float, float] = None,
+                       azimuth_range: Tuple[float, float] = None,
+                       mask: np.ndarray = None,
+                       dark: np.ndarray = None,
+                       flat: np.ndarray = None,
+                       polarization_factor: float = None,
+                       method: str = 'splitbbox',
+                       normalization_factor: float = 1,
+                       chunk_size: int = None,
+                       workers: int = 1,
+                       variance: np.ndarray = None,
+                       error_model: str = None) -> Tuple[np.ndarray, ...]:
+    """Radially integrate a stack whose geometry changes from frame to frame (one geometry per frame).
+
+    Frames sharing a geometry are integrated together with one engine; engines are cached like `sparse_integrator`, so
+    positions revisited later in a scan (or in another reduction) reuse theirs. Returns (frames x npt) arrays of the
+    bin centers of each frame and of the intensities, and of their standard errors as in `integrate1d_stack`.
+    """
+    def integrator_for(geometry, shape):
+        return sparse_integrator(geometry, shape, npt, unit, radial_range, azimuth_range, mask, method)
+
+    return _integrate_by_geometry(integrator_for, geometries, data, npt, dark, flat, polarization_factor,
+                                  normalization_factor, chunk_size, workers, variance, error_model)
+
+
+def integrate_chi_frames(geometries: Sequence,
+                         data,
+                         npt_azim: int,
+                         unit: Union[str, units.Unit] = 'q_A^-1',
+                         radial_range: Tuple[float, float] = None,
+                         azimuth_range: Tuple[float, float] = None,
+                         mask: np.ndarray = None,
+                         dark: np.ndarray = None,
+                         flat: np.ndarray = None,
+                         polarization_factor: float = None,
+                         method: str = 'splitbbox',
+                         normalization_factor: float = 1,
+                         chunk_size: int = None,
+                         workers: int = 1,
+                         variance: np.ndarray = None,
+                         error_model: str = None) -> Tuple[np.ndarray, ...]:
+    """Azimuthally profile a stack with one geometry per frame, grouped like `integrate1d_frames`."""
+    def integrator_for(geometry, shape):
+        return chi_integrator(geometry, shape, npt_azim, unit, radial_range, azimuth_range, mask, method)
+
+    return _integrate_by_geometry(integrator_for, geometries, data, npt_azim, dark, flat, polarization_factor,
+                                  normalization_factor, chunk_size, workers, variance, error_model)
+
+
+_LINE_Q_CACHE_SIZE = 16
+_line_q_cache = OrderedDict()
+
+
+def line_q(azimuthal_integrator, shape: Tuple[int, int], axis: int) -> np.ndarray:
+    """Signed q (in inverse angstroms) along the detector row (`axis=-1`) or column (`axis=-2`) through the beam center.
+
+    q is negative before the beam center; the column axis is returned top-down flipped, as plotted by `z_integrate`.
+    The result is cached per geometry and shape and must not be modified.
+    """
+    axis = axis % 2
+    key = geometry_key(azimuthal_integrator), tuple(shape), axis
+
+    def build():
+        fit2d = azimuthal_integrator.getFit2D()
+        center_x, center_z = fit2d['centerX'], fit2d['centerY']
+        if axis:
+            pixels = np.arange(shape[1])
+            q = azimuthal_integrator.qFunction(np.full(shape[1], center_z), pixels) / 10.
+            q[pixels < center_x] *= -1.
+        else:
+            pixels = np.arange(shape[0])
+            q = azimuthal_integrator.qFunction(pixels, np.full(shape[0], center_x)) / 10.
+            q[pixels < center_z] *= -1.
+            q = q[::-1]
+        q.flags.writeable = False
+        return q
+
+    return _cached(_line_q_cache, key, build, _LINE_Q_CACHE_SIZE)
+
+
+def line_q_frames(geometries: Sequence, shape: Tuple[int, int], axis: int) -> np.ndarray:
+    """`line_q` of every frame of a stack with one geometry per frame, as a (frames x pixels) array.
+
+    q is computed once per distinct geometry (see `group_frames_by_geometry`).
+    """
+    q = np.empty((len(geometries), shape[axis]))
+    for geometry, indices in group_frames_by_geometry(geometries):
+        q[indices] = line_q(geometry, shape, axis)
+    return q
+
+
+def line_weights(shape: Tuple[int, int],
+                 mask: np.ndarray = None,
+                 dark: np.ndarray = None,
+                 flat: np.ndarray = None,
+                 normalization_factor: float = 1) -> np.ndarray:
+    """float32 per-pixel weights of the x/z integrations: the normalized flat response, zero for masked pixels."""
+    dark = np.zeros(shape, dtype=np.float32) if dark is None else np.asarray(dark, dtype=np.float32)
+    response = (np.ones(shape, dtype=np.float32) if flat is None else np.asarray(flat, dtype=np.float32)) - dark
+    weights = np.average(response) / response / np.float32(normalization_factor)
+    if mask is not None:
+        weights[np.asarray(mask, dtype=bool)] = 0
+    return weights
+
+
+def integrate_lines(data, axis: int, weights: np.ndarray, dark: np.ndarray = None, chunk_size: int = None,
+                    workers: int = 1, variance: np.ndarray = None, error_model: str = None):
+    """Sum every frame of a stack along `axis` of the image, as sum((frame - dark) * weights).
+
+    Each chunk of frames is reduced by a single `einsum` (by `workers` threads concurrently); the dark offset is
+    folded into a per-line constant. Dask stacks are reduced lazily, one block of frames at a time. Standard errors
+    are returned as well with an `error_model` or a `variance`, as in `SparseIntegrator.integrate`; the variances are
+    summed with the squared weights.
+    """
+    if error_model not in (None, 'poisson'):
+        raise ValueError(f'Unknown error model "{error_model}"; expected "poisson".')
+    with_sigma = error_model is not None or variance is not None
+    if data.ndim == 2:
+        data = data[None]
+    axis = axis % 2
+    subscripts = 'fij,ij->fj' if axis == 0 else 'fij,ij->fi'
+    offset = 0 if dark is None else np.sum(np.asarray(dark, dtype=np.float32) * weights, axis=axis)
+    squared_weights = weights ** 2
+    stacked_variance = variance is not None and np.ndim(variance) == 3
+    if variance is not None and not stacked_variance:
+        line_variance = np.sum(np.asarray(variance, dtype=np.float32) * squared_weights, axis=axis)
+
+    def reduce(chunk, variance_chunk=None):
+        chunk = np.asarray(chunk, dtype=np.float32)
+        intensity = np.einsum(subscripts, chunk, weights) - offset
+        if not with_sigma:
+            return intensity
+        if stacked_variance:
+            binned = np.einsum(subscripts, np.asarray(variance_chunk, dtype=np.float32), squared_weights)
+        elif variance is not None:
+            binned = line_variance
+        else:
+            binned = np.einsum(subscripts, np.maximum(chunk, 1), squared_weights)
+        return np.stack(np.broadcast_arrays(intensity, np.sqrt(binned)), axis=1)
+
+    if isinstance(data, da.Array):
+        data = data.rechunk({1: -1, 2: -1})
+        if not with_sigma:
+            return data.map_blocks(reduce, drop_axis=axis + 1, dtype=np.float32)
+        stacks = [data]
+        if stacked_variance:
+            stacks.append(da.asarray(variance).rechunk(data.chunks))
+        length = data.shape[-1] if axis == 0 else data.shape[-2]
+        results = da.map_blocks(reduce, *stacks, chunks=(data.chunks[0], (2,), (length,)), dtype=np.float32)
+    elif stacked_variance:
+        results = np.concatenate(list(map_frame_chunks(lambda blocks: reduce(*blocks), FrameStacks(data, variance),
+                                                       chunk_size, workers)))
+    else:
+        results = np.concatenate(list(map_frame_chunks(reduce, data, chunk_size, workers)))
+    return (results[:, 0], results[:, 1]) if with_sigma else results
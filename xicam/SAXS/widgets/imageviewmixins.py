@@ -1,16 +1,34 @@
+import threading
+from collections import OrderedDict
+
 from databroker import Broker
 from qtpy.QtWidgets import QPushButton, QSizePolicy
 import numpy as np
 
+from xicam.core import threads
 from xicam.gui.widgets.imageviewmixins import BetterLayout, ProcessingView
 
 from xicam.SAXS.operations.correction import correct
+from xicam.SAXS.operations.darks import dark_model
 
 
 class BackgroundCorrected(BetterLayout, ProcessingView):
-    """Toggle background correction for an image or image series."""
+    """Toggle background correction for an image or image series.
+
+    Corrected frames are kept in a bounded LRU cache, and while scrubbing through a series the next
+    `prefetch_frames` frames in the scrub direction are corrected in the background.
+    """
+    cache_size = 24
+    prefetch_frames = 4
+
     def __init__(self, *args, darks=None, **kwargs):
         self._darks = None
+        self._flats = None
+        self._corrected_frames = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._last_index = None
+        self._prefetch_thread = None
+        self._prefetch_request = None
         self.set_darks(darks)
         self._bg_correction = False
         self._bg_correct_btn = QPushButton("BG Correction")
@@ -31,6 +49,11 @@ class BackgroundCorrected(BetterLayout, ProcessingView):
         """Override to add additional `darks` kwarg for dark image."""
         if darks is not None and self._darks is not None:
             self._darks = darks
+        if img is not getattr(self, 'image', None):
+            # Cached frames are keyed on the id of their series, which may be reused once the old series is freed
+            self._prefetch_request = None
+            with self._cache_lock:
+                self._corrected_frames.clear()
         self.set_darks(darks)  # Can't do this before... self.image won't be set until super call
         super(BackgroundCorrected, self).setImage(img, *args, **kwargs)
 
@@ -39,7 +62,9 @@ class BackgroundCorrected(BetterLayout, ProcessingView):
         if darks is not None:
             self._darks = darks
             if self._darks.ndim == 3:
-                self._darks = np.mean(self._darks, axis=0)
+                self._darks = dark_model(self._darks).dark_frame
+            with self._cache_lock:
+                self._corrected_frames.clear()
             self._bg_correct_btn.setEnabled(True)
             self._toggle_bg_correction(True)
 
@@ -58,8 +83,56 @@ class BackgroundCorrected(BetterLayout, ProcessingView):
 
     def process(self, image):
         """Either returns the raw image or the correct image, depending on the bg correction button state."""
-        if self._bg_correction:
-            flats = np.ones_like(image)
-            if self._darks is not None:
-                image = correct(np.expand_dims(image, 0), flats, self._darks)[0]
+        if self._bg_correction and self._darks is not None:
+            index = self.currentIndex if getattr(self.image, 'ndim', 0) == 3 else None
+            image = self._corrected_frame(self.image, self._darks, index, image)
+            if index is not None:
+                self._prefetch(index)
         return super(BackgroundCorrected, self).process(image)
+
+    def _corrected_frame(self, series, darks, index, image):
+        key = id(series), id(darks), index
+        with self._cache_lock:
+            corrected = self._corrected_frames.get(key)
+            if corrected is not None:
+                self._corrected_frames.move_to_end(key)
+                return corrected
+
+        # The flats buffer is allocated once (its identity also keeps the decoded correction tables cached)
+        flats = self._flats
+        if flats is None or flats.shape != image.shape:
+            flats = self._flats = np.ones(image.shape, dtype=np.uint16)
+        corrected = correct(np.expand_dims(image, 0), flats, darks)[0]
+
+        with self._cache_lock:
+            if series is not self.image or darks is not self._darks:
+                # A prefetch that finished after the image (or darks) changed; its key may not stay unique
+                return corrected
+            self._corrected_frames[key] = corrected
+            while len(self._corrected_frames) > self.cache_size:
+                self._corrected_frames.popitem(last=False)
+        return corrected
+
+    def _prefetch(self, index):
+        """Correct the next frames in the scrub direction in a background thread."""
+        step = -1 if self._last_index is not None and index < self._last_index else 1
+        self._last_index = index
+
+        series, darks = self.image, self._darks
+        indices = [i for i in range(index + step, index + step * (self.prefetch_frames + 1), step)
+                   if 0 <= i < len(series) and (id(series), id(darks), i) not in self._corrected_frames]
+        if not indices:
+            return
+        # A running prefetch picks up the newest request once it finishes its current frame
+        self._prefetch_request = series, darks, indices
+        if self._prefetch_thread is None or not self._prefetch_thread.running:
+            self._prefetch_thread = threads.QThreadFuture(self._prefetch_frames, showBusy=False)
+            self._prefetch_thread.start()
+
+    def _prefetch_frames(self):
+        while self._prefetch_request is not None:
+            (series, darks, indices), self._prefetch_request = self._prefetch_request, None
+            for i in indices:
+                if self._prefetch_request is not None:
+                    break
+                self._corrected_frame(series, darks, i, np.asarray(series[i]))
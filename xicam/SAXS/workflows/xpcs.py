@@ -8,7 +8,7 @@ from ..operations.average_intensity import average_intensity
 from ..operations.fitting import fit_scattering_factor
 from ..operations.fourierautocorrelator import fourier_correlation
 from ..operations.onetime import one_time_correlation
-from ..operations.twotime import two_time_correlation
+from ..operations.twotime import two_time_correlation, matmul_two_time_correlation
 from ..operations.correction import correct_fastccd_image
 from ..operations.diffusion_coefficient import diffusion_coefficient
 
@@ -34,7 +34,9 @@ class TwoTimeAlgorithms(ProcessingAlgorithms):
     @staticmethod
     def algorithms():
         """Returns a dict where keys are the algorithm (workflow) names, values are the algorithms (workflows)."""
-        return {TwoTime.name: TwoTime}
+        return {TwoTime.name: TwoTime,
+                MatMulTwoTime.name: MatMulTwoTime,
+                FusedMatMulTwoTime.name: FusedMatMulTwoTime}
 
     @staticmethod
     def default():
@@ -49,6 +51,8 @@ class OneTimeAlgorithms(ProcessingAlgorithms):
     def algorithms():
         """Returns a dict where keys are the algorithm (workflow) names, values are the algorithms (workflows)."""
         return {OneTime.name: OneTime,
+                NumbaOneTime.name: NumbaOneTime,
+                FusedOneTime.name: FusedOneTime,
                 FourierAutocorrelator.name: FourierAutocorrelator}
 
     @staticmethod
@@ -58,9 +62,13 @@ class OneTimeAlgorithms(ProcessingAlgorithms):
 
 
 class XPCSWorkflow(Workflow):
+    # When fused, the corrected stack is never materialized: frames are cropped, corrected and fed to the correlation
+    # one chunk at a time
+    fused = False
+
     def __init__(self):
         super(XPCSWorkflow, self).__init__()
-        self.correct_image = correct_fastccd_image()
+        self.correct_image = correct_fastccd_image(fused=self.fused)
         self.add_operation(self.correct_image)
 
 
@@ -134,12 +142,30 @@ class TwoTime(XPCSWorkflow):
         yield 'stop', run_bundle.compose_stop()
 
 
+class MatMulTwoTime(XPCSWorkflow):
+    name = '2-Time Correlation (Matrix Multiply)'
+
+    def __init__(self):
+        super(MatMulTwoTime, self).__init__()
+        twotime = matmul_two_time_correlation()
+        self.add_operation(twotime)
+        self.add_link(self.correct_image, twotime, 'images', 'images')
+
+    document = staticmethod(TwoTime.document)
+
+
+class FusedMatMulTwoTime(MatMulTwoTime):
+    name = '2-Time Correlation (Matrix Multiply, Fused)'
+    fused = True
+
+
 class OneTime(XPCSWorkflow):
     name = '1-Time Correlation'
+    engine = 'numpy'
 
     def __init__(self):
         super(OneTime, self).__init__()
-        onetime = one_time_correlation()
+        onetime = one_time_correlation(streaming=self.fused, engine=self.engine)
         fitting = fit_scattering_factor()
         average_i = average_intensity()
         diffusion = diffusion_coefficient()
@@ -225,6 +251,16 @@ class OneTime(XPCSWorkflow):
         yield 'stop', run_bundle.compose_stop()
 
 
+class NumbaOneTime(OneTime):
+    name = '1-Time Correlation (Numba)'
+    engine = 'numba'
+
+
+class FusedOneTime(NumbaOneTime):
+    name = '1-Time Correlation (Fused)'
+    fused = True
+
+
 class FourierAutocorrelator(XPCSWorkflow):
     name = 'Fourier Correlation'
 